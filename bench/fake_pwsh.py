@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# 模拟`powershell-worker.ps1`的PowerShell工作进程，忽略所有命令行参数。
+# 通过环境变量调整行为：
+#   BENCH_PWSH_STARTUP_MS      启动(连接Exchange Online)耗时，默认500
+#   BENCH_PWSH_CREATE_MS       每个共享邮箱的创建耗时，默认200
+#   BENCH_PWSH_CHECK_MS        每次检查的耗时，默认50
+#   BENCH_PWSH_ERROR_RATE      创建失败的比例，默认0
+#   BENCH_PWSH_READY_RATE      每次检查时新邮箱已经生效的比例，默认1
+import os
+import sys
+import json
+import time
+import random
+
+RESPONSE_PREFIX = '@@RESPONSE@@ '
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def respond(response: dict):
+    sys.stdout.write(RESPONSE_PREFIX + json.dumps(response) + '\n')
+    sys.stdout.flush()
+
+
+def main():
+    create_seconds = env_float('BENCH_PWSH_CREATE_MS', 200) / 1000
+    check_seconds = env_float('BENCH_PWSH_CHECK_MS', 50) / 1000
+    error_rate = env_float('BENCH_PWSH_ERROR_RATE', 0)
+    ready_rate = env_float('BENCH_PWSH_READY_RATE', 1)
+
+    time.sleep(env_float('BENCH_PWSH_STARTUP_MS', 500) / 1000)
+    print('Connected to fake Exchange Online.', flush=True)
+    respond({'id': 0, 'ok': True, 'result': 'ready'})
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        op = request.get('op')
+        if op == 'ping':
+            result = ['pong']
+        elif op == 'create_mailboxes':
+            result = []
+            for target in request['targets']:
+                time.sleep(create_seconds)
+                if random.random() < error_rate:
+                    result.append({'address': target['address'], 'ok': False, 'error': 'Injected error'})
+                else:
+                    result.append({'address': target['address'], 'ok': True})
+        elif op == 'check_mailboxes':
+            time.sleep(check_seconds)
+            result = [{'address': address, 'ready': random.random() < ready_rate} for address in request['addresses']]
+        elif op == 'exit':
+            respond({'id': request['id'], 'ok': True, 'result': ['bye']})
+            return
+        else:
+            respond({'id': request['id'], 'ok': False, 'error': f'Unknown op: {op}'})
+            continue
+        respond({'id': request['id'], 'ok': True, 'result': result})
+
+
+if __name__ == '__main__':
+    main()
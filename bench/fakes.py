@@ -0,0 +1,465 @@
+import time
+import uuid
+import socket
+import random
+import asyncio
+import logging
+from aiohttp import web
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult, LoginPassword
+
+logger = logging.getLogger(__name__)
+logging.getLogger('mail.log').setLevel(logging.ERROR)
+
+
+class Behavior:
+    """
+    模拟服务的行为：每个请求的延迟、随机失败的比例和限流。
+
+    `throttle_per_second`为每秒允许的请求数，超出时按服务的方式返回限流响应，0为不限流。
+    """
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0,
+                 throttle_per_second: float = 0, retry_after_seconds: int = 1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_per_second = throttle_per_second
+        self.retry_after_seconds = retry_after_seconds
+        self.__window_start = 0.0
+        self.__window_count = 0
+
+    async def delay(self):
+        latency = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    def throttled(self) -> bool:
+        if self.throttle_per_second <= 0:
+            return False
+        now = time.monotonic()
+        if now - self.__window_start >= 1:
+            self.__window_start = now
+            self.__window_count = 0
+        self.__window_count += 1
+        return self.__window_count > self.throttle_per_second
+
+    def failed(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class FakeMicrosoftCloud:
+    """
+    模拟Microsoft Entra的token接口和Microsoft Graph的用户、发信接口。
+
+    目录中预置`known_users`个用户(`known<N>@<domain>`)，发信接口只读取请求体，不做任何投递。
+    token接口和Graph接口分别使用`token_behavior`和`graph_behavior`。
+    `mailbox_throttle_per_second`为每个代理邮箱每秒允许的发信请求数，模拟Exchange Online对单个邮箱的限制，0为不限流。
+    """
+
+    def __init__(self, domain: str, known_users: int = 1000, token_behavior: Behavior | None = None,
+                 graph_behavior: Behavior | None = None, page_size: int = 999, mailbox_throttle_per_second: float = 0):
+        self.domain = domain
+        self.known_users = known_users
+        self.token_behavior = token_behavior or Behavior()
+        self.graph_behavior = graph_behavior or Behavior()
+        self.page_size = page_size
+        self.mailbox_throttle_per_second = mailbox_throttle_per_second
+        self.__mailbox_behaviors: dict[str, Behavior] = {}
+        self.stats: dict[str, int] = {}
+        self.base_url = ''
+        self.__runner: web.AppRunner | None = None
+
+    def __count(self, key: str):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def __user(self, index: int) -> dict:
+        address = f'known{index}@{self.domain}'
+        return {'id': f'user-{index}', 'mail': address, 'proxyAddresses': [f'SMTP:{address}']}
+
+    async def __token(self, request: web.Request) -> web.Response:
+        self.__count('token')
+        await request.post()
+        await self.token_behavior.delay()
+        if self.token_behavior.failed():
+            return web.json_response({'error': 'temporarily_unavailable'}, status=503)
+        return web.json_response({'token_type': 'Bearer', 'expires_in': 3599, 'access_token': uuid.uuid4().hex})
+
+    def __mailbox_throttled(self, mailbox: str) -> bool:
+        """记录代理邮箱的发信请求，超出单个邮箱的限制时返回`True`"""
+        self.__count(f'mailbox:{mailbox.lower()}')
+        behavior = self.__mailbox_behaviors.setdefault(
+            mailbox.lower(), Behavior(throttle_per_second=self.mailbox_throttle_per_second)
+        )
+        if behavior.throttled():
+            self.__count('mailbox_throttled')
+            return True
+        return False
+
+    @staticmethod
+    def __mailbox_throttled_body() -> dict:
+        return {'error': {'code': 'ApplicationThrottled', 'message': 'Mailbox send limit exceeded'}}
+
+    async def __graph_response(self, status: int, body: dict | None = None) -> web.Response:
+        """按照Graph行为返回限流、失败或正常的响应"""
+        await self.graph_behavior.delay()
+        if self.graph_behavior.throttled():
+            self.__count('throttled')
+            return web.json_response(
+                {'error': {'code': 'ApplicationThrottled', 'message': 'Too many requests'}}, status=429,
+                headers={'Retry-After': str(self.graph_behavior.retry_after_seconds)}
+            )
+        if self.graph_behavior.failed():
+            self.__count('failed')
+            return web.json_response({'error': {'code': 'ServiceUnavailable', 'message': 'Injected error'}},
+                                     status=503)
+        if body is None:
+            return web.Response(status=status)
+        return web.json_response(body, status=status)
+
+    async def __users(self, request: web.Request) -> web.Response:
+        self.__count('users')
+        skip = int(request.query.get('$skiptoken', 0))
+        users = [self.__user(i) for i in range(skip, min(skip + self.page_size, self.known_users))]
+        body = {'value': users}
+        if skip + self.page_size < self.known_users:
+            body['@odata.nextLink'] = f'{self.base_url}/v1.0/users?$skiptoken={skip + self.page_size}'
+        return await self.__graph_response(200, body)
+
+    async def __users_delta(self, request: web.Request) -> web.Response:
+        self.__count('users_delta')
+        return await self.__graph_response(200, {
+            'value': [], '@odata.deltaLink': f'{self.base_url}/v1.0/users/delta?$deltatoken={uuid.uuid4().hex}'
+        })
+
+    async def __send_mail(self, request: web.Request) -> web.Response:
+        self.__count('send_mail')
+        await request.read()
+        if self.__mailbox_throttled(request.match_info['user']):
+            return web.json_response(self.__mailbox_throttled_body(), status=429, headers={'Retry-After': '1'})
+        return await self.__graph_response(202)
+
+    async def __create_message(self, request: web.Request) -> web.Response:
+        self.__count('create_message')
+        await request.read()
+        return await self.__graph_response(201, {'id': uuid.uuid4().hex})
+
+    async def __add_attachment(self, request: web.Request) -> web.Response:
+        self.__count('add_attachment')
+        await request.read()
+        return await self.__graph_response(201, {'id': uuid.uuid4().hex})
+
+    async def __create_upload_session(self, request: web.Request) -> web.Response:
+        self.__count('create_upload_session')
+        await request.read()
+        return await self.__graph_response(201, {'uploadUrl': f'{self.base_url}/upload/{uuid.uuid4().hex}'})
+
+    async def __upload(self, request: web.Request) -> web.Response:
+        self.__count('upload')
+        await request.read()
+        return await self.__graph_response(200, {})
+
+    async def __send_message(self, request: web.Request) -> web.Response:
+        self.__count('send_message')
+        if self.__mailbox_throttled(request.match_info['user']):
+            return web.json_response(self.__mailbox_throttled_body(), status=429, headers={'Retry-After': '1'})
+        return await self.__graph_response(202)
+
+    async def __delete_message(self, request: web.Request) -> web.Response:
+        self.__count('delete_message')
+        return await self.__graph_response(204)
+
+    async def __batch(self, request: web.Request) -> web.Response:
+        self.__count('batch')
+        requests = (await request.json())['requests']
+        await self.graph_behavior.delay()
+        responses = []
+        for item in requests:
+            self.__count('batch_item')
+            if self.__mailbox_throttled(item['url'].split('/')[2]):
+                responses.append({'id': item['id'], 'status': 429, 'headers': {'Retry-After': '1'},
+                                  'body': self.__mailbox_throttled_body()})
+            elif self.graph_behavior.throttled():
+                self.__count('throttled')
+                responses.append({'id': item['id'], 'status': 429,
+                                  'headers': {'Retry-After': str(self.graph_behavior.retry_after_seconds)},
+                                  'body': {'error': {'code': 'ApplicationThrottled', 'message': 'Too many requests'}}})
+            elif self.graph_behavior.failed():
+                self.__count('failed')
+                responses.append({'id': item['id'], 'status': 503,
+                                  'body': {'error': {'code': 'ServiceUnavailable', 'message': 'Injected error'}}})
+            else:
+                responses.append({'id': item['id'], 'status': 202, 'body': None})
+        return web.json_response({'responses': responses})
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post('/{tenant}/oauth2/v2.0/token', self.__token)
+        app.router.add_get('/v1.0/users', self.__users)
+        app.router.add_get('/v1.0/users/delta', self.__users_delta)
+        app.router.add_post('/v1.0/users/{user}/sendMail', self.__send_mail)
+        app.router.add_post('/v1.0/users/{user}/messages', self.__create_message)
+        app.router.add_post('/v1.0/users/{user}/messages/{id}/attachments', self.__add_attachment)
+        app.router.add_post('/v1.0/users/{user}/messages/{id}/attachments/createUploadSession',
+                            self.__create_upload_session)
+        app.router.add_post('/v1.0/users/{user}/messages/{id}/send', self.__send_message)
+        app.router.add_delete('/v1.0/users/{user}/messages/{id}', self.__delete_message)
+        app.router.add_put('/upload/{id}', self.__upload)
+        app.router.add_post('/v1.0/$batch', self.__batch)
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{host}:{port}'
+
+    async def stop(self):
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+
+class FakeDirectMailApi:
+    """
+    模拟阿里云DirectMail的OpenAPI(RPC风格)，支持发信地址的查询、创建、修改和删除。
+
+    限流时返回`Throttling.User`错误，失败时返回`ServiceUnavailable`错误。
+    """
+
+    def __init__(self, behavior: Behavior | None = None):
+        self.behavior = behavior or Behavior()
+        self.addresses: dict[str, str] = {}  # 地址ID -> 地址
+        self.stats: dict[str, int] = {}
+        self.endpoint = ''
+        self.__runner: web.AppRunner | None = None
+
+    @staticmethod
+    def __error(status: int, code: str, message: str) -> web.Response:
+        return web.json_response({'Code': code, 'Message': message, 'RequestId': uuid.uuid4().hex}, status=status)
+
+    async def __handle(self, request: web.Request) -> web.Response:
+        params = dict(request.query)
+        params.update(await request.post())
+        action = params.get('Action') or request.headers.get('x-acs-action', '')
+        self.stats[action] = self.stats.get(action, 0) + 1
+        await self.behavior.delay()
+        if self.behavior.throttled():
+            return self.__error(400, 'Throttling.User', 'Request was denied due to user flow control.')
+        if self.behavior.failed():
+            return self.__error(503, 'ServiceUnavailable', 'Injected error')
+        request_id = uuid.uuid4().hex
+        if action == 'QueryMailAddressByParam':
+            items = [{'AccountName': address, 'MailAddressId': address_id, 'Sendtype': 'trigger'}
+                     for address_id, address in self.addresses.items()]
+            return web.json_response({'RequestId': request_id, 'TotalCount': len(items),
+                                      'PageNumber': 1, 'PageSize': len(items), 'data': {'mailAddress': items}})
+        if action == 'CreateMailAddress':
+            address = params.get('AccountName', '')
+            if address.lower() in (value.lower() for value in self.addresses.values()):
+                return self.__error(400, 'InvalidMailAddress.Duplicate', 'The mail address already exists.')
+            address_id = str(random.randint(10 ** 8, 10 ** 9))
+            self.addresses[address_id] = address
+            return web.json_response({'RequestId': request_id, 'MailAddressId': address_id})
+        if action == 'ModifyMailAddress':
+            if params.get('MailAddressId') not in self.addresses:
+                return self.__error(404, 'InvalidMailAddressId.Malformed', 'The mail address does not exist.')
+            return web.json_response({'RequestId': request_id})
+        if action == 'DeleteMailAddress':
+            if self.addresses.pop(params.get('MailAddressId'), None) is None:
+                return self.__error(404, 'InvalidMailAddressId.Malformed', 'The mail address does not exist.')
+            return web.json_response({'RequestId': request_id})
+        return self.__error(400, 'InvalidAction', f'Unsupported action `{action}`.')
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        app = web.Application()
+        app.router.add_route('*', '/', self.__handle)
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.endpoint = f'{host}:{port}'
+
+    async def stop(self):
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+
+class FakeSmtpRelay:
+    """
+    模拟需要认证的SMTP中继(如阿里云DirectMail的SMTP服务)，接受任意用户名和密码。
+
+    限流时返回`421`并断开连接，失败时返回`451`。在独立的线程中运行。
+    """
+
+    def __init__(self, behavior: Behavior | None = None):
+        self.behavior = behavior or Behavior()
+        self.stats: dict[str, int] = {}
+        self.port = 0
+        self.__controller: Controller | None = None
+
+    def __count(self, key: str):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def __authenticate(self, server, session, envelope, mechanism, auth_data) -> AuthResult:
+        self.__count('auth')
+        return AuthResult(success=isinstance(auth_data, LoginPassword))
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        self.__count('data')
+        await self.behavior.delay()
+        if self.behavior.throttled():
+            self.__count('throttled')
+            return '421 Too many messages, try again later'
+        if self.behavior.failed():
+            self.__count('failed')
+            return '451 Injected error'
+        return '250 Data Ok: queued'
+
+    def start(self, host: str = '127.0.0.1', port: int = 0):
+        if not port:
+            port = free_port(host)
+        self.__controller = Controller(self, hostname=host, port=port, authenticator=self.__authenticate,
+                                       auth_require_tls=False, data_size_limit=0)
+        self.__controller.start()
+        self.port = port
+
+    def stop(self):
+        if self.__controller is not None:
+            self.__controller.stop()
+
+
+class FakeRedisServer:
+    """
+    模拟兼容Redis协议(RESP)的存储，用于测试共享的邮件循环检测状态。
+
+    只支持中继用到的命令：`PING`、`AUTH`、`SELECT`、`GET`、`SET`(`NX`、`PX`)、`INCR`、`PEXPIRE`、`PTTL`和`MGET`。
+    数据保存在内存中，过期的键在访问时删除。每条命令的处理都使用`behavior`的延迟，失败时返回错误响应。
+    """
+
+    def __init__(self, behavior: Behavior | None = None):
+        self.behavior = behavior or Behavior()
+        self.stats: dict[str, int] = {}
+        self.port = 0
+        self.__data: dict[bytes, tuple[bytes, float | None]] = {}  # 键 -> (值, 过期时间)
+        self.__server: asyncio.Server | None = None
+        self.__handlers: set[asyncio.Task] = set()
+
+    def __count(self, key: str):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def __get(self, key: bytes) -> bytes | None:
+        item = self.__data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.monotonic():
+            del self.__data[key]
+            return None
+        return item[0]
+
+    @staticmethod
+    def __encode(reply) -> bytes:
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, Exception):
+            return f'-ERR {reply}\r\n'.encode()
+        if isinstance(reply, str):
+            return f'+{reply}\r\n'.encode()
+        if isinstance(reply, int):
+            return f':{reply}\r\n'.encode()
+        if isinstance(reply, list):
+            return f'*{len(reply)}\r\n'.encode() + b''.join(FakeRedisServer.__encode(item) for item in reply)
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+
+    def __execute(self, command: str, args: list[bytes]):
+        now = time.monotonic()
+        if command == 'PING':
+            return 'PONG'
+        if command in ('AUTH', 'SELECT'):
+            return 'OK'
+        if command == 'GET':
+            return self.__get(args[0])
+        if command == 'MGET':
+            return [self.__get(key) for key in args]
+        if command == 'SET':
+            options = [arg.upper() for arg in args[2:]]
+            if b'NX' in options and self.__get(args[0]) is not None:
+                return None
+            expire_at = None
+            if b'PX' in options:
+                expire_at = now + int(args[2 + options.index(b'PX') + 1]) / 1000
+            self.__data[args[0]] = (args[1], expire_at)
+            return 'OK'
+        if command == 'INCR':
+            value = self.__get(args[0])
+            try:
+                number = int(value or 0) + 1
+            except ValueError:
+                return ValueError('value is not an integer or out of range')
+            expire_at = self.__data[args[0]][1] if value is not None else None
+            self.__data[args[0]] = (str(number).encode(), expire_at)
+            return number
+        if command == 'PEXPIRE':
+            if self.__get(args[0]) is None:
+                return 0
+            self.__data[args[0]] = (self.__data[args[0]][0], now + int(args[1]) / 1000)
+            return 1
+        if command == 'PTTL':
+            if self.__get(args[0]) is None:
+                return -2
+            expire_at = self.__data[args[0]][1]
+            return -1 if expire_at is None else max(int((expire_at - now) * 1000), 0)
+        return ValueError(f"unknown command '{command}'")
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.__handlers.add(task)
+        try:
+            while True:
+                header = await reader.readline()
+                if not header:
+                    break
+                if not header.startswith(b'*'):
+                    writer.write(self.__encode(ValueError('Protocol error: expected an array')))
+                    break
+                args = []
+                for _ in range(int(header[1:])):
+                    length = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                command = args[0].decode().upper()
+                self.__count(command.lower())
+                await self.behavior.delay()
+                if self.behavior.failed():
+                    self.__count('failed')
+                    reply = RuntimeError('Injected error')
+                else:
+                    reply = self.__execute(command, args[1:])
+                writer.write(self.__encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            self.__handlers.discard(task)
+            writer.close()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self.__server = await asyncio.start_server(self.__handle, host, port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+
+    @property
+    def url(self) -> str:
+        return f'redis://127.0.0.1:{self.port}/0'
+
+    async def stop(self):
+        if self.__server is not None:
+            self.__server.close()
+            # 断开中继仍保持的连接
+            for task in list(self.__handlers):
+                task.cancel()
+            await asyncio.gather(*self.__handlers, return_exceptions=True)
+            await self.__server.wait_closed()
+
+
+def free_port(host: str = '127.0.0.1') -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
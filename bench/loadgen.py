@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+SMTP负载生成器。
+
+启动N个并发的SMTP客户端，每个客户端保持一个连接，连续发送指定大小分布的邮件，
+统计每封邮件从`MAIL FROM`到`DATA`响应的耗时(即中继接受邮件的延迟)，输出吞吐量和延迟分位数。
+可以单独运行，对任意SMTP中继施压：
+
+    python bench/loadgen.py --port 2525 --clients 20 --messages 2000 --sizes 2k:80,64k:15,4m:5
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import aiosmtplib
+
+UNIQUE = b'@@UNIQUE@@'
+
+
+def parse_size(value: str) -> int:
+    units = {'k': 1024, 'm': 1024 * 1024}
+    value = value.strip().lower()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_size_mix(value: str) -> list[tuple[int, float]]:
+    """解析`大小:权重,大小:权重`格式的邮件大小分布，例如`2k:80,64k:15,4m:5`"""
+    mix = []
+    for item in value.split(','):
+        size, _, weight = item.partition(':')
+        mix.append((parse_size(size), float(weight or 1)))
+    return mix
+
+
+def build_template(size: int) -> bytes:
+    """
+    构造约`size`字节的邮件模板，发送前替换其中的占位符。
+
+    256KB以下为纯文本邮件，更大的邮件带有一个base64编码的附件。
+    每封邮件的正文都不同，避免被中继的邮件循环检测拦截。
+    """
+    headers = (b'From: Bench <{from}>\r\nTo: <{to}>\r\nSubject: Bench message ' + UNIQUE + b'\r\n'
+               b'Message-ID: <' + UNIQUE + b'@bench.local>\r\nMIME-Version: 1.0\r\n')
+    line = b'The quick brown fox jumps over the lazy dog 0123456789 ABCDEFGHIJKLMNOPQRSTUVWXY\r\n'
+    if size < 256 * 1024:
+        body = UNIQUE + b'\r\n' + line * max((size - len(headers)) // len(line), 1)
+        return headers + b'Content-Type: text/plain; charset=utf-8\r\n\r\n' + body
+    boundary = b'bench-boundary'
+    attachment_line = b'QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVphYmNkZWZnaGlqa2xtbm9wcXJzdHV2d3h5ejAxMjM0\r\n'
+    return (headers + b'Content-Type: multipart/mixed; boundary="' + boundary + b'"\r\n\r\n'
+            b'--' + boundary + b'\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n' + UNIQUE + b'\r\n' + line * 10 +
+            b'--' + boundary + b'\r\nContent-Type: application/octet-stream\r\n'
+            b'Content-Disposition: attachment; filename="bench.bin"\r\nContent-Transfer-Encoding: base64\r\n\r\n' +
+            attachment_line * (size // len(attachment_line)) +
+            b'--' + boundary + b'--\r\n')
+
+
+class LoadGenerator:
+    def __init__(self, host: str, port: int, clients: int = 10, messages: int = 1000, duration: float = 0,
+                 sizes: str = '2k', domain: str = 'bench.example', known_senders: int = 100,
+                 new_sender_ratio: float = 0.0, recipient: str = 'rcpt@example.net', timeout: float = 600):
+        self.host = host
+        self.port = port
+        self.clients = clients
+        self.messages = messages
+        self.duration = duration
+        self.domain = domain
+        self.known_senders = max(known_senders, 1)
+        self.new_sender_ratio = new_sender_ratio
+        self.recipient = recipient
+        self.timeout = timeout
+        self.__mix = parse_size_mix(sizes)
+        self.__templates = {size: build_template(size) for size, _ in self.__mix}
+        self.__run_id = uuid.uuid4().hex[:8]
+        self.__issued = 0
+        self.__new_senders = 0
+        self.__deadline = 0.0
+        self.latencies: list[float] = []
+        self.replies: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.sent_bytes = 0
+
+    def __next_message(self) -> tuple[str, bytes] | None:
+        if self.duration > 0:
+            if time.monotonic() >= self.__deadline:
+                return None
+        elif self.__issued >= self.messages:
+            return None
+        self.__issued += 1
+        if random.random() < self.new_sender_ratio:
+            self.__new_senders += 1
+            sender = f'bench-{self.__run_id}-{self.__new_senders}@{self.domain}'
+        else:
+            sender = f'known{random.randrange(self.known_senders)}@{self.domain}'
+        size = random.choices([size for size, _ in self.__mix], [weight for _, weight in self.__mix])[0]
+        content = (self.__templates[size]
+                   .replace(b'{from}', sender.encode(), 1)
+                   .replace(b'{to}', self.recipient.encode(), 1)
+                   .replace(UNIQUE, f'{self.__run_id}-{self.__issued}'.encode()))
+        return sender, content
+
+    def __count(self, counter: dict[str, int], key: str):
+        counter[key] = counter.get(key, 0) + 1
+
+    async def __client(self):
+        client: aiosmtplib.SMTP | None = None
+        while (message := self.__next_message()) is not None:
+            sender, content = message
+            try:
+                if client is None or not client.is_connected:
+                    client = aiosmtplib.SMTP(hostname=self.host, port=self.port, timeout=self.timeout)
+                    await client.connect()
+                start = time.perf_counter()
+                await client.sendmail(sender, [self.recipient], content)
+                self.latencies.append(time.perf_counter() - start)
+                self.sent_bytes += len(content)
+                self.__count(self.replies, '250')
+            except aiosmtplib.SMTPResponseException as e:
+                self.__count(self.replies, str(e.code))
+                try:
+                    await client.rset()
+                except aiosmtplib.SMTPException:
+                    client.close()
+            except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as e:
+                self.__count(self.errors, type(e).__name__)
+                if client is not None:
+                    client.close()
+                client = None
+        if client is not None and client.is_connected:
+            try:
+                await client.quit()
+            except aiosmtplib.SMTPException:
+                client.close()
+
+    async def run(self) -> dict:
+        start = time.monotonic()
+        self.__deadline = start + self.duration
+        await asyncio.gather(*(self.__client() for _ in range(self.clients)))
+        elapsed = time.monotonic() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> float | None:
+            if not latencies:
+                return None
+            return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 2)
+
+        accepted = sum(count for code, count in self.replies.items() if code.startswith('2'))
+        return {
+            'messages': self.__issued,
+            'accepted': accepted,
+            'replies': dict(sorted(self.replies.items())),
+            'errors': self.errors,
+            'new_senders': self.__new_senders,
+            'elapsed_seconds': round(elapsed, 3),
+            'accepted_per_second': round(accepted / elapsed, 2) if elapsed else None,
+            'megabytes_per_second': round(self.sent_bytes / elapsed / 1024 / 1024, 2) if elapsed else None,
+            'latency_ms': {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99),
+                           'max': round(latencies[-1] * 1000, 2) if latencies else None}
+        }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--clients', type=int, default=10, help='并发的SMTP客户端数量')
+    parser.add_argument('--messages', type=int, default=1000, help='发送的邮件总数')
+    parser.add_argument('--duration', type=float, default=0, help='按时长发送(秒)，指定后忽略--messages')
+    parser.add_argument('--sizes', default='2k', help='邮件大小分布，例如`2k:80,64k:15,4m:5`')
+    parser.add_argument('--domain', default='bench.example', help='发信地址的域名')
+    parser.add_argument('--known-senders', type=int, default=100, help='已知发信地址(known<N>@域名)的数量')
+    parser.add_argument('--new-sender-ratio', type=float, default=0.0, help='使用新发信地址的邮件比例')
+    parser.add_argument('--recipient', default='rcpt@example.net', help='收信地址')
+
+
+def create_from_args(args: argparse.Namespace, host: str, port: int) -> LoadGenerator:
+    return LoadGenerator(
+        host=host, port=port, clients=args.clients, messages=args.messages, duration=args.duration,
+        sizes=args.sizes, domain=args.domain, known_senders=args.known_senders,
+        new_sender_ratio=args.new_sender_ratio, recipient=args.recipient
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=25)
+    add_arguments(parser)
+    args = parser.parse_args()
+    report = asyncio.run(create_from_args(args, args.host, args.port).run())
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
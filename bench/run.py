@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+离线基准测试。
+
+在本机启动模拟的Microsoft Entra/Graph、阿里云DirectMail API和SMTP中继，以及模拟的PowerShell工作进程，
+用指向这些模拟服务的临时配置启动`src/main.py`，再用负载生成器施压，输出吞吐量、接受延迟分位数和峰值内存。
+不需要任何网络连接。例如：
+
+    python bench/run.py --adapter microsoft_exchange_online --clients 50 --messages 5000 --sizes 2k:90,64k:10
+    python bench/run.py --adapter aliyun_directmail --known-senders 4 --new-sender-ratio 0.01
+"""
+import os
+import sys
+import json
+import time
+import yaml
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from fakes import Behavior, FakeMicrosoftCloud, FakeDirectMailApi, FakeSmtpRelay, FakeRedisServer, free_port
+from loadgen import add_arguments, create_from_args
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+CONFIG_TEMPLATE = os.path.join(os.path.dirname(BENCH_DIR), 'config', 'config.yaml')
+
+
+def process_tree_memory(root_pid: int, exclude: str = 'fake_pwsh.py') -> dict[str, int] | None:
+    """
+    统计进程树的常驻内存(字节)，不计入模拟的PowerShell工作进程。不支持`/proc`时返回`None`。
+
+    返回`VmRSS`(全部常驻内存)和`RssAnon`(匿名内存，不包括文件映射和共享内存)。
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    children: dict[int, list[int]] = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat', 'r') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    total = {'VmRSS': 0, 'RssAnon': 0}
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                if exclude.encode() in f.read():
+                    continue
+            with open(f'/proc/{pid}/status', 'r') as f:
+                for line in f:
+                    field, _, value = line.partition(':')
+                    if field in total:
+                        total[field] += int(value.split()[0]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak: dict[str, int] | None = None
+        self.__task: asyncio.Task | None = None
+
+    async def __task_sample(self):
+        while True:
+            memory = await asyncio.to_thread(process_tree_memory, self.pid)
+            if memory is not None:
+                self.peak = {field: max((self.peak or {}).get(field, 0), value) for field, value in memory.items()}
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.__task = asyncio.create_task(self.__task_sample())
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+
+
+def build_config(args: argparse.Namespace, work_dir: str, smtp_port: int, fakes: dict) -> dict:
+    """以仓库中的配置文件为模板，生成指向模拟服务的配置"""
+    with open(CONFIG_TEMPLATE, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    config['log'].update(level=args.log_level, dump_enabled=False)
+    config['smtp_server'].update(listen_host='127.0.0.1', listen_port=smtp_port, workers=args.workers,
+                                 email_loop_backend=args.loop_backend, email_loop_alert_to_email='')
+    if args.loop_backend == 'redis':
+        config['smtp_server']['email_loop_redis_url'] = fakes['redis'].url
+    config['adapter']['use'] = args.adapter
+    config['spool'] = dict(config.get('spool') or {}, enabled=args.spool, path=os.path.join(work_dir, 'spool'))
+    config['metrics'] = dict(config.get('metrics') or {}, enabled=False)
+    if args.adapter == 'microsoft_exchange_online':
+        certificate_path = os.path.join(work_dir, 'cert.pfx')
+        with open(certificate_path, 'wb') as f:
+            f.write(b'bench')
+        config['microsoft_exchange_online'].update(
+            organization=args.domain, tenant_id='bench-tenant', client_id='bench-client', client_secret='bench',
+            sender=','.join(f'relay{i}@{args.domain}' for i in range(args.sender_mailboxes)),
+            certificate_path=certificate_path, certificate_b64='',
+            powershell_cmd=os.path.join(BENCH_DIR, 'fake_pwsh.py'), powershell_startup_timeout_seconds=30,
+            initial_user_waiting_seconds=0, readiness_poll_interval_seconds=0.2,
+            directory_snapshot_path='', directory_sync_interval_seconds=0,
+            graph_base_url=fakes['microsoft'].base_url, login_base_url=fakes['microsoft'].base_url
+        )
+    else:
+        config['aliyun_directmail'].update(
+            access_key_id='bench', access_key_secret='bench',
+            api_endpoint=fakes['directmail_api'].endpoint, api_protocol='http',
+            smtp_ssl_encrypt=False, smtp_host='127.0.0.1', smtp_port=fakes['smtp_relay'].port,
+            # 已知发信地址作为静态地址，新发信地址使用工作地址池
+            static_addresses_password={f'known{i}@{args.domain}': 'bench' for i in range(args.known_senders)},
+            working_addresses_record_path=os.path.join(work_dir, 'aliyun_directmail_addresses.json')
+        )
+    for item in args.set:
+        # `--set 节.配置项=值`，值按YAML解析
+        key, _, value = item.partition('=')
+        section, _, field = key.partition('.')
+        config.setdefault(section, {})[field] = yaml.safe_load(value)
+    return config
+
+
+async def wait_for_port(port: int, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Relay exited during startup with code {process.returncode}.')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'Relay did not listen on port {port} within {timeout}s.')
+
+
+async def run(args: argparse.Namespace) -> dict:
+    fakes = {}
+    microsoft = FakeMicrosoftCloud(
+        domain=args.domain, known_users=args.known_senders,
+        token_behavior=Behavior(latency_ms=args.token_latency_ms),
+        graph_behavior=Behavior(latency_ms=args.graph_latency_ms, jitter_ms=args.graph_jitter_ms,
+                                error_rate=args.graph_error_rate, throttle_per_second=args.graph_throttle),
+        mailbox_throttle_per_second=args.mailbox_throttle
+    )
+    directmail_api = FakeDirectMailApi(Behavior(latency_ms=args.api_latency_ms, error_rate=args.api_error_rate,
+                                                throttle_per_second=args.api_throttle))
+    smtp_relay = FakeSmtpRelay(Behavior(latency_ms=args.smtp_latency_ms, jitter_ms=args.smtp_jitter_ms,
+                                        error_rate=args.smtp_error_rate, throttle_per_second=args.smtp_throttle))
+    if args.adapter == 'microsoft_exchange_online':
+        await microsoft.start()
+        fakes['microsoft'] = microsoft
+    else:
+        await directmail_api.start()
+        smtp_relay.start()
+        fakes['directmail_api'] = directmail_api
+        fakes['smtp_relay'] = smtp_relay
+    redis = FakeRedisServer(Behavior(latency_ms=args.redis_latency_ms))
+    if args.loop_backend == 'redis':
+        await redis.start()
+        fakes['redis'] = redis
+
+    work_dir = tempfile.mkdtemp(prefix='smtp-relayer-bench-')
+    smtp_port = args.port or free_port()
+    config_path = os.path.join(work_dir, 'config.yaml')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(build_config(args, work_dir, smtp_port, fakes), f, allow_unicode=True)
+    env = dict(os.environ, APP_CONFIG_PATH=config_path, PYTHONUNBUFFERED='1',
+               BENCH_PWSH_STARTUP_MS=str(args.pwsh_startup_ms), BENCH_PWSH_CREATE_MS=str(args.pwsh_create_ms),
+               BENCH_PWSH_ERROR_RATE=str(args.pwsh_error_rate))
+    log_path = os.path.join(work_dir, 'relay.log')
+    with open(log_path, 'wb') as log:
+        process = subprocess.Popen([sys.executable, 'main.py'], cwd=SRC_DIR, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+    sampler = RssSampler(process.pid)
+    try:
+        try:
+            await wait_for_port(smtp_port, process, args.startup_timeout)
+        except RuntimeError as e:
+            raise RuntimeError(f'{e} See `{log_path}`.')
+        idle_memory = await asyncio.to_thread(process_tree_memory, process.pid)
+        sampler.start()
+        report = await create_from_args(args, '127.0.0.1', smtp_port).run()
+    finally:
+        sampler.stop()
+        process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.to_thread(process.wait, 30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        if 'microsoft' in fakes:
+            await microsoft.stop()
+        if 'directmail_api' in fakes:
+            await directmail_api.stop()
+            smtp_relay.stop()
+        if 'redis' in fakes:
+            await redis.stop()
+
+    report['adapter'] = args.adapter
+    report['workers'] = args.workers
+    report['spool'] = args.spool
+    for name, memory in (('idle', idle_memory), ('peak', sampler.peak)):
+        report[f'{name}_rss_mb'] = round(memory['VmRSS'] / 1024 / 1024, 1) if memory is not None else None
+        report[f'{name}_anon_rss_mb'] = round(memory['RssAnon'] / 1024 / 1024, 1) if memory is not None else None
+    report['fake_requests'] = {name: fake.stats for name, fake in fakes.items()}
+    report['relay_log'] = log_path
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--adapter', default='microsoft_exchange_online',
+                        choices=['microsoft_exchange_online', 'aliyun_directmail'])
+    parser.add_argument('--workers', type=int, default=1, help='中继的工作进程数量')
+    parser.add_argument('--spool', action='store_true', help='启用中继的本地邮件队列')
+    parser.add_argument('--port', type=int, default=0, help='中继监听的端口，默认随机选择空闲端口')
+    parser.add_argument('--log-level', default='WARNING', help='中继的日志级别')
+    parser.add_argument('--startup-timeout', type=float, default=60, help='等待中继启动的最长时间(秒)')
+    parser.add_argument('--output', help='将结果以JSON格式写入此文件')
+    parser.add_argument('--sender-mailboxes', type=int, default=1,
+                        help='Microsoft Exchange Online适配器的代理邮箱数量(relay<N>@域名)')
+    parser.add_argument('--loop-backend', choices=('memory', 'redis'), default='memory',
+                        help='邮件循环检测的状态存储，`redis`时使用模拟的Redis服务')
+    parser.add_argument('--set', action='append', default=[], metavar='SECTION.FIELD=VALUE',
+                        help='覆盖中继的配置项，可以多次指定，例如`--set microsoft_exchange_online.batch_max_size=1`')
+    add_arguments(parser)
+    group = parser.add_argument_group('模拟服务')
+    group.add_argument('--token-latency-ms', type=float, default=20)
+    group.add_argument('--graph-latency-ms', type=float, default=50)
+    group.add_argument('--graph-jitter-ms', type=float, default=20)
+    group.add_argument('--graph-error-rate', type=float, default=0)
+    group.add_argument('--graph-throttle', type=float, default=0, help='Graph每秒允许的请求数，0为不限流')
+    group.add_argument('--mailbox-throttle', type=float, default=0, help='每个代理邮箱每秒允许的发信请求数，0为不限流')
+    group.add_argument('--api-latency-ms', type=float, default=50, help='DirectMail API的延迟')
+    group.add_argument('--api-error-rate', type=float, default=0)
+    group.add_argument('--api-throttle', type=float, default=0)
+    group.add_argument('--smtp-latency-ms', type=float, default=30, help='DirectMail SMTP的DATA延迟')
+    group.add_argument('--smtp-jitter-ms', type=float, default=10)
+    group.add_argument('--smtp-error-rate', type=float, default=0)
+    group.add_argument('--smtp-throttle', type=float, default=0)
+    group.add_argument('--redis-latency-ms', type=float, default=0, help='模拟的Redis服务每条命令的延迟')
+    group.add_argument('--pwsh-startup-ms', type=float, default=500)
+    group.add_argument('--pwsh-create-ms', type=float, default=200)
+    group.add_argument('--pwsh-error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    try:
+        report = asyncio.run(run(args))
+    except RuntimeError as e:
+        sys.exit(str(e))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,13 @@
 # 适配阿里云邮件推送服务(DirectMail)
 import os
+import json
 import time
 import yaml
 import random
 import string
-import smtplib
+import asyncio
 import logging
+import aiosmtplib
 import multiprocessing as mp
 from aiosmtpd.smtp import Envelope
 from multiprocessing.managers import SyncManager
@@ -14,9 +16,11 @@ from pydantic import BaseModel
 from alibabacloud_tea_openapi import models as open_api_models
 from alibabacloud_dm20151123.client import Client as Client
 from alibabacloud_dm20151123 import models as models
+from util import MailContext
+from config import CONFIG_PATH
+from metrics import STAGE_SECONDS
 from adapter.base import AdapterBase
-from email import message_from_bytes
-from email.utils import parseaddr
+from adapter.aliyun_directmail.smtp_pool import SmtpConnectionPool
 
 
 logger = logging.getLogger(__name__)
@@ -24,9 +28,19 @@ logger = logging.getLogger(__name__)
 class Config(BaseModel):
     access_key_id: str
     access_key_secret: str
+    api_endpoint: str = 'dm.aliyuncs.com'
+    api_protocol: str = 'https'
     smtp_ssl_encrypt: bool = True
+    smtp_host: str = 'smtpdm.aliyun.com'
+    smtp_port: int = 0
+    smtp_timeout_seconds: float = 30
+    smtp_pool_max_connections: int = 4
+    smtp_pool_idle_timeout_seconds: float = 60
+    smtp_pool_noop_after_seconds: float = 10
     static_addresses_password: dict[str, str] = {}
     mail_addresses_pool_count: int = 6
+    mail_addresses_wait_timeout_seconds: float = 60
+    working_addresses_record_path: str = '../data/aliyun_directmail_addresses.json'
 
 class Adapter(AdapterBase):
     def __init__(self):
@@ -35,8 +49,11 @@ class Adapter(AdapterBase):
 
         self.__multiprocessing_manager: SyncManager | None = None
         self.working_addresses: dict | None = None
+        self.__created_addresses: dict | None = None  # 中继创建的工作地址，地址 -> 地址ID
+        self.__pool_lock = None
+        self.__smtp_pool: SmtpConnectionPool | None = None
 
-        with open('../config/config.yaml', 'r', encoding='utf-8') as f:
+        with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
             self.CONFIG = Config(
                 **yaml.safe_load(f)['aliyun_directmail']
             )
@@ -51,13 +68,16 @@ class Adapter(AdapterBase):
                 except Exception as e:
                     raise ValueError(f'Failed to parse config `{self.name}.{field}` '
                                      f'from env `APP_{self.name.upper()}_{field.upper()}`: {e}')
+        self.client = self.__create_client()
+
+    def __create_client(self) -> Client:
         __config = open_api_models.Config(
             access_key_id=self.CONFIG.access_key_id,
-            access_key_secret=self.CONFIG.access_key_secret
+            access_key_secret=self.CONFIG.access_key_secret,
+            protocol=self.CONFIG.api_protocol
         )
-        __config.endpoint = 'dm.aliyuncs.com'
-
-        self.client = Client(config=__config)
+        __config.endpoint = self.CONFIG.api_endpoint
+        return Client(config=__config)
 
     @classmethod
     def __generate_password(cls):
@@ -107,108 +127,322 @@ class Adapter(AdapterBase):
 
         return password
 
-    def __create_address(self, address: str):
-        while ((address in self.working_addresses) or
-               (len(self.working_addresses) >= self.CONFIG.mail_addresses_pool_count)):
-            time.sleep(0.1)
-        self.working_addresses[address] = self.__multiprocessing_manager.dict(
-            {'id': None, 'password': None}
-        )
+    def __query_addresses(self) -> list[tuple[str, str]]:
+        """查询所有触发类型的发信地址，返回(地址, 地址ID)列表"""
+        addresses = []
+        page_no = 1
+        while True:
+            request = models.QueryMailAddressByParamRequest()
+            request.sendtype = 'trigger'
+            request.page_no = page_no
+            request.page_size = 100
+            body = self.client.query_mail_address_by_param(request).body
+            items = body.data.mail_address if body.data and body.data.mail_address else []
+            addresses.extend((item.account_name, item.mail_address_id) for item in items)
+            if not items or len(addresses) >= (body.total_count or 0):
+                return addresses
+            page_no += 1
+
+    def __load_record(self) -> dict[str, str]:
+        path = self.CONFIG.working_addresses_record_path
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                addresses = json.load(f)['addresses']
+            return {str(address).lower(): str(mail_address_id) for address, mail_address_id in addresses.items()}
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            logger.warning(f'Ignoring unreadable working mail address record `{path}`: {e}')
+            return {}
+
+    def __save_record(self):
+        """保存中继创建的工作地址。调用时需持有地址池的锁"""
+        path = self.CONFIG.working_addresses_record_path
+        if not path:
+            return
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'saved_at': time.time(), 'addresses': dict(self.__created_addresses)}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f'Failed to save working mail address record `{path}`: {e}')
+
+    def __record_address(self, address: str, mail_address_id: str | None):
+        """记录中继创建的工作地址，`mail_address_id`为`None`时表示地址已被删除"""
+        with self.__pool_lock:
+            self.__created_addresses.pop(address, None)
+            if mail_address_id is not None:
+                self.__created_addresses[address] = mail_address_id
+            self.__save_record()
+
+    def __create_address(self, address: str) -> str:
+        """
+        创建发信地址并返回地址ID。
+
+        地址已经存在时，只接管中继自己创建的地址(例如上次运行遗留的地址)，不使用在控制台中手动创建的地址。
+        """
         request = models.CreateMailAddressRequest()
         request.account_name = address
         request.sendtype = 'trigger'
         try:
-            response = self.client.create_mail_address(request)
-            self.working_addresses[address] = self.__multiprocessing_manager.dict(
-                {'id': response.body.mail_address_id, 'password': None}
-            )
+            mail_address_id = self.client.create_mail_address(request).body.mail_address_id
         except Exception as e:
+            if address in self.__created_addresses:
+                try:
+                    for account_name, mail_address_id in self.__query_addresses():
+                        if account_name.lower() == address:
+                            logger.info(f'Working mail address `{address}` already exists. Adopting it.')
+                            self.__record_address(address, mail_address_id)
+                            return mail_address_id
+                except Exception as query_error:
+                    logger.warning(f'Failed to query existing mail addresses: {query_error}')
             error = f'Failed to create working mail address `{address}`:\n\t{e}'
             logger.error(error)
-            del self.working_addresses[address]
             raise Exception(error)
+        self.__record_address(address, mail_address_id)
+        return mail_address_id
 
-    def __set_smtp_password(self, address: str):
-        self.working_addresses[address] = self.__multiprocessing_manager.dict(
-            {'id': self.working_addresses[address]["id"], 'password': self.__generate_password()}
-        )
+    def __set_smtp_password(self, address: str, mail_address_id: str) -> str:
+        """为发信地址设置新的SMTP密码并返回密码"""
         request = models.ModifyMailAddressRequest()
-        request.mail_address_id = self.working_addresses[address]['id']
-        request.password = self.working_addresses[address]['password']
+        request.mail_address_id = mail_address_id
+        request.password = self.__generate_password()
         try:
             self.client.modify_mail_address(request)
+            return request.password
         except Exception as e:
             error = f'Failed to set SMTP password for working mail address `{address}`:\n\t{e}'
             logger.error(error)
-            del self.working_addresses[address]
-            raise Exception(error)
-
-    def __send_mail(self, envelope: Envelope, username: str, password: str):
-        try:
-            if self.CONFIG.smtp_ssl_encrypt:
-                with smtplib.SMTP_SSL('smtpdm.aliyun.com', 465) as smtp:
-                    smtp.login(username, password)
-                    smtp.sendmail(username, envelope.rcpt_tos, envelope.content)
-            else:
-                with smtplib.SMTP('smtpdm.aliyun.com', 80) as smtp:
-                    smtp.login(username, password)
-                    smtp.sendmail(username, envelope.rcpt_tos, envelope.content)
-        except Exception as e:
-            error = f'Failed to send mail by `{username}`:\n\t{e}'
-            logger.error(error)
-            if username in self.working_addresses:
-                del self.working_addresses[username]
             raise Exception(error)
 
-    def __delete_address(self, address: str):
+    def __delete_address(self, address: str, mail_address_id: str):
         request = models.DeleteMailAddressRequest()
-        request.mail_address_id = self.working_addresses[address]
+        request.mail_address_id = mail_address_id
         try:
             self.client.delete_mail_address(request)
-            del self.working_addresses[address]
         except ClientException as e:
-            if e.status_code == 404:
-                logger.warning(f'Working address `{address}` does not exist. Did you delete it manually?')
-                del self.working_addresses[address]
-        except Exception as e:
-            error = f'Failed to delete working mail address `{address}`:\n\t{e}'
+            if e.status_code != 404:
+                raise
+            logger.warning(f'Working address `{address}` does not exist. Did you delete it manually?')
+
+    def __reserve_address(self, address: str) -> tuple[dict, tuple[str, str] | None] | None:
+        """
+        在工作地址池中占用发信地址。
+
+        地址已经可用时返回其记录；需要创建地址或设置密码时，占用一条`pending`记录并返回，
+        池已满时同时返回被淘汰的最久未使用的空闲地址。需要等待时返回`None`。
+        """
+        with self.__pool_lock:
+            entry = self.working_addresses.get(address)
+            if entry is not None and entry['state'] == 'ready':
+                entry['in_use'] += 1
+                entry['last_used'] = time.time()
+                self.working_addresses[address] = entry
+                return entry, None
+            if entry is not None and entry['state'] == 'adopted':
+                # 上次运行遗留的地址，只需要重新设置密码
+                entry.update(state='pending', in_use=entry['in_use'] + 1, last_used=time.time())
+                self.working_addresses[address] = entry
+                return entry, None
+            if entry is not None:
+                return None
+            evicted = None
+            if len(self.working_addresses) >= self.CONFIG.mail_addresses_pool_count:
+                idle = [(value['last_used'], key) for key, value in self.working_addresses.items()
+                        if value['state'] != 'pending' and value['in_use'] == 0]
+                if not idle:
+                    return None
+                evicted_address = min(idle)[1]
+                evicted = (evicted_address, self.working_addresses.pop(evicted_address)['id'])
+            entry = {'id': None, 'password': None, 'state': 'pending', 'in_use': 1, 'last_used': time.time()}
+            self.working_addresses[address] = entry
+            return entry, evicted
+
+    def __finish_address(self, address: str, entry: dict | None):
+        """地址准备完成后标记为可用，准备失败时(`entry`为`None`)移出地址池"""
+        with self.__pool_lock:
+            if entry is None:
+                self.working_addresses.pop(address, None)
+                return
+            current = self.working_addresses[address]
+            current.update(id=entry['id'], password=entry['password'], state='ready')
+            self.working_addresses[address] = current
+
+    async def __acquire_address(self, address: str) -> str:
+        """
+        从工作地址池中取得发信地址的SMTP密码。
+
+        地址池以地址为键，记录地址ID、SMTP密码、正在使用的数量和最近使用时间，由所有工作进程共享。
+        地址已在池中时直接复用；不在池中时创建地址并设置密码，池已满时先删除最久未使用的空闲地址。
+        地址正在被其他调用者创建、或池已满且没有空闲地址时等待，检查的间隔按指数退避，
+        超过`mail_addresses_wait_timeout_seconds`秒后抛出`451`临时错误。
+        地址池和阿里云API的调用都是阻塞的，放到线程中执行。
+        """
+        deadline = time.monotonic() + self.CONFIG.mail_addresses_wait_timeout_seconds
+        interval = 0.1
+        while (reserved := await asyncio.to_thread(self.__reserve_address, address)) is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                error = (f'Timed out after {self.CONFIG.mail_addresses_wait_timeout_seconds:.0f}s waiting for '
+                         f'working mail address `{address}`. The pool is busy.')
+                logger.warning(error)
+                raise Exception(f'451 {error}')
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, 2)
+        entry, evicted = reserved
+        if entry['state'] == 'ready':
+            return entry['password']
+
+        __timer_start = time.perf_counter()
+        try:
+            if evicted is not None:
+                logger.debug('Working mail address pool is full. Deleting least recently used `%s`...', evicted[0])
+                try:
+                    await asyncio.to_thread(self.__delete_address, *evicted)
+                    await asyncio.to_thread(self.__record_address, evicted[0], None)
+                except Exception as e:
+                    logger.warning(f'Failed to delete working mail address `{evicted[0]}`: {e}')
+            if entry['id'] is None:
+                logger.debug('Creating working mail address `%s`...', address)
+                entry['id'] = await asyncio.to_thread(self.__create_address, address)
+            logger.debug('Setting SMTP password for working mail address `%s`...', address)
+            entry['password'] = await asyncio.to_thread(self.__set_smtp_password, address, entry['id'])
+        except BaseException:
+            await asyncio.to_thread(self.__finish_address, address, None)
+            raise
+        await asyncio.to_thread(self.__finish_address, address, entry)
+        STAGE_SECONDS.observe(time.perf_counter() - __timer_start, stage='provisioning')
+        return entry['password']
+
+    def __release_address(self, address: str, discard: bool = False):
+        """发送完成后归还地址。`discard`为真时把地址移出地址池，下次使用时重新接管并设置密码"""
+        with self.__pool_lock:
+            entry = self.working_addresses.get(address)
+            if entry is None:
+                return
+            entry['in_use'] = max(entry['in_use'] - 1, 0)
+            if discard and entry['state'] == 'ready':
+                entry['state'] = 'adopted'
+                entry['password'] = None
+            self.working_addresses[address] = entry
+
+    async def __send_mail(self, envelope: Envelope, username: str, password: str):
+        try:
+            with STAGE_SECONDS.time(stage='smtp_send'):
+                await self.__smtp_pool.send(username, password, envelope.rcpt_tos, envelope.content)
+        except aiosmtplib.SMTPResponseException as e:
+            error = f'Failed to send mail by `{username}`: {e.message}'
             logger.error(error)
-            raise Exception(error)
+            # 服务端的拒绝原因原样响应给客户端，认证失败视为临时错误
+            code = 451 if isinstance(e, aiosmtplib.SMTPAuthenticationError) else e.code
+            raise Exception(f'{code} {error}') from e
+        except aiosmtplib.SMTPRecipientsRefused as e:
+            error = f'Failed to send mail by `{username}`: {"; ".join(str(r) for r in e.recipients)}'
+            logger.error(error)
+            raise Exception(f'{e.recipients[0].code if e.recipients else 550} {error}') from e
+        except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as e:
+            error = f'Failed to send mail by `{username}`: {e}'
+            logger.error(error)
+            raise Exception(f'451 {error}') from e
 
     def main_start(self):
-        # 地址创建队列
+        # 工作地址池，由所有工作进程/线程共享
         self.__multiprocessing_manager = mp.Manager()
         self.working_addresses = self.__multiprocessing_manager.dict()
+        self.__pool_lock = self.__multiprocessing_manager.Lock()
+        self.__created_addresses = self.__multiprocessing_manager.dict(self.__load_record())
+        if self.__created_addresses:
+            self.__adopt_addresses()
+
+    def __adopt_addresses(self):
+        """
+        接管上次运行遗留的工作地址，不需要删除后重新创建。
+
+        只接管记录中由中继创建的地址，在控制台中手动创建的地址不会进入地址池，也不会被淘汰删除。
+        最多接管`mail_addresses_pool_count`个最近创建的地址，其余遗留的地址直接删除。
+        """
+        static_addresses = {address.lower() for address in self.CONFIG.static_addresses_password}
+        try:
+            existing = {account_name.lower(): mail_address_id
+                        for account_name, mail_address_id in self.__query_addresses()}
+        except Exception as e:
+            # 无法确认地址是否仍然存在时保留记录，创建地址时发现已存在再接管
+            logger.warning(f'Failed to query existing working mail addresses: {e}')
+            return
+        owned = [(address, existing[address]) for address in self.__created_addresses.keys()
+                 if address in existing and address not in static_addresses]
+        surplus = max(len(owned) - self.CONFIG.mail_addresses_pool_count, 0)
+        record = {}
+        for address, mail_address_id in owned[:surplus]:
+            logger.debug('Deleting surplus working mail address `%s`...', address)
+            try:
+                self.__delete_address(address, mail_address_id)
+            except Exception as e:
+                logger.warning(f'Failed to delete working mail address `{address}`: {e}')
+                record[address] = mail_address_id
+        for address, mail_address_id in owned[surplus:]:
+            record[address] = mail_address_id
+            self.working_addresses[address] = {
+                'id': mail_address_id, 'password': None, 'state': 'adopted', 'in_use': 0, 'last_used': 0
+            }
+        with self.__pool_lock:
+            self.__created_addresses.clear()
+            self.__created_addresses.update(record)
+            self.__save_record()
+        if self.working_addresses:
+            logger.info(f'Adopted {len(self.working_addresses)} existing working mail address(es).')
+
+    def start(self):
+        port = self.CONFIG.smtp_port or (465 if self.CONFIG.smtp_ssl_encrypt else 80)
+        self.__smtp_pool = SmtpConnectionPool(
+            hostname=self.CONFIG.smtp_host,
+            port=port,
+            use_tls=self.CONFIG.smtp_ssl_encrypt,
+            timeout=self.CONFIG.smtp_timeout_seconds,
+            max_connections=self.CONFIG.smtp_pool_max_connections,
+            idle_timeout_seconds=self.CONFIG.smtp_pool_idle_timeout_seconds,
+            noop_after_seconds=self.CONFIG.smtp_pool_noop_after_seconds
+        )
+        self.__smtp_pool.start()
 
-    def send_mail(self, envelope: Envelope) -> str:
+    async def send_mail(self, envelope: Envelope) -> str:
         logger.info('Sending mail...')
-        raw_mail = envelope.content  # bytes
-        mail = message_from_bytes(raw_mail)
-        from_header = mail.get("From")
-        _, from_addr = parseaddr(from_header)
+        _, from_addr = MailContext.of(envelope).sender
         if from_addr == '':
             error = '550 A `from address` field is required.'
             logger.error(error)
             return error
 
         if from_addr not in self.CONFIG.static_addresses_password:
-            logger.debug(f'Sender address `{from_addr}` is not a static mail address.')
-            logger.debug('Creating working mail address...')
-            self.__create_address(from_addr)
-            logger.debug('Setting SMTP password for working mail address...')
-            self.__set_smtp_password(from_addr)
+            logger.debug('Sender address `%s` is not a static mail address.', from_addr)
+            from_addr = from_addr.lower()
+            password = await self.__acquire_address(from_addr)
             logger.debug('Sending mail by working mail address...')
-            password = self.working_addresses[from_addr]['password']
+            discard = False
+            try:
+                await self.__send_mail(envelope, from_addr, password)
+            except Exception as e:
+                # 密码失效(例如地址在控制台中被修改)时，下次使用前重新设置密码
+                discard = isinstance(e.__cause__, aiosmtplib.SMTPAuthenticationError)
+                raise
+            finally:
+                await asyncio.to_thread(self.__release_address, from_addr, discard)
         else:
-            logger.debug(f'Sender address `{from_addr}` is a static mail address.')
+            logger.debug('Sender address `%s` is a static mail address.', from_addr)
             logger.debug('Sending mail by static mail address...')
             password = self.CONFIG.static_addresses_password[from_addr]
-        self.__send_mail(envelope, from_addr, password)
-        if from_addr not in self.CONFIG.static_addresses_password:
-            logger.debug('Deleting working mail address...')
-            self.__delete_address(from_addr)
+            await self.__send_mail(envelope, from_addr, password)
 
         return "250 Message accepted for delivery"
 
-    def stop(self):
+    async def stop(self):
+        if self.__smtp_pool is not None:
+            await self.__smtp_pool.close()
+            self.__smtp_pool = None
+
+    def main_stop(self):
         self.__multiprocessing_manager.shutdown()
@@ -0,0 +1,139 @@
+import time
+import asyncio
+import logging
+import aiosmtplib
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class SmtpConnectionPool:
+    """
+    已认证的SMTP连接池。
+
+    按(用户名, 密码)分别保存空闲连接，同一组凭据的多封邮件复用同一个已登录的会话，省去每封邮件的TLS握手和认证。
+    同一组凭据同时最多打开`max_connections`个连接。空闲超过`noop_after_seconds`的连接在复用前用`NOOP`检查是否仍然可用，
+    空闲超过`idle_timeout_seconds`的连接会被关闭。事务被服务端拒绝后用`RSET`重置会话，连接继续复用；
+    复用的连接在发送时断开时，使用新连接重试一次。
+    """
+
+    def __init__(self, hostname: str, port: int, use_tls: bool = True, timeout: float = 30,
+                 max_connections: int = 4, idle_timeout_seconds: float = 60, noop_after_seconds: float = 10):
+        self.hostname = hostname
+        self.port = port
+        self.__use_tls = use_tls
+        self.__timeout = timeout
+        self.__max_connections = max(max_connections, 1)
+        self.__idle_timeout_seconds = idle_timeout_seconds
+        self.__noop_after_seconds = noop_after_seconds
+        self.__idle: dict[tuple[str, str], deque[tuple[aiosmtplib.SMTP, float]]] = {}
+        self.__semaphores: dict[tuple[str, str], asyncio.Semaphore] = {}
+        self.__active: dict[tuple[str, str], int] = {}
+        self.__cleanup_task: asyncio.Task | None = None
+
+    async def __connect(self, username: str, password: str) -> aiosmtplib.SMTP:
+        client = aiosmtplib.SMTP(hostname=self.hostname, port=self.port, use_tls=self.__use_tls,
+                                 start_tls=False, timeout=self.__timeout)
+        await client.connect()
+        try:
+            await client.login(username, password)
+        except BaseException:
+            client.close()
+            raise
+        logger.debug('Opened SMTP session for `%s` to %s:%d.', username, self.hostname, self.port)
+        return client
+
+    async def __take_idle(self, key: tuple[str, str]) -> aiosmtplib.SMTP | None:
+        """取出一个仍然可用的空闲连接，没有时返回`None`"""
+        idle = self.__idle.get(key)
+        while idle:
+            client, last_used = idle.pop()
+            if not client.is_connected:
+                continue
+            if time.monotonic() - last_used >= self.__noop_after_seconds:
+                try:
+                    await client.noop()
+                except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError):
+                    client.close()
+                    continue
+            return client
+        return None
+
+    def __put_idle(self, key: tuple[str, str], client: aiosmtplib.SMTP):
+        if client.is_connected:
+            self.__idle.setdefault(key, deque()).append((client, time.monotonic()))
+
+    async def send(self, username: str, password: str, recipients: list[str], content):
+        """使用`username`的会话发送邮件。服务端拒绝时抛出`aiosmtplib.SMTPResponseException`"""
+        key = (username, password)
+        semaphore = self.__semaphores.setdefault(key, asyncio.Semaphore(self.__max_connections))
+        async with semaphore:
+            self.__active[key] = self.__active.get(key, 0) + 1
+            try:
+                await self.__send(key, recipients, content)
+            finally:
+                self.__active[key] -= 1
+
+    async def __send(self, key: tuple[str, str], recipients: list[str], content):
+        username, password = key
+        client = await self.__take_idle(key)
+        reused = client is not None
+        if client is None:
+            client = await self.__connect(username, password)
+        try:
+            try:
+                await client.sendmail(username, recipients, content)
+            except aiosmtplib.SMTPServerDisconnected:
+                if not reused:
+                    raise
+                # 复用的连接可能已经被服务端关闭，换一个新连接重试
+                client.close()
+                client = await self.__connect(username, password)
+                await client.sendmail(username, recipients, content)
+        except aiosmtplib.SMTPResponseException as e:
+            if e.code == 421:
+                client.close()
+                raise
+            try:
+                await client.rset()
+                self.__put_idle(key, client)
+            except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError):
+                client.close()
+            raise
+        except BaseException:
+            client.close()
+            raise
+        self.__put_idle(key, client)
+
+    async def __task_cleanup(self):
+        """定期关闭空闲时间过长的连接"""
+        while True:
+            await asyncio.sleep(max(self.__idle_timeout_seconds / 2, 1))
+            now = time.monotonic()
+            for key, idle in list(self.__idle.items()):
+                while idle and now - idle[0][1] >= self.__idle_timeout_seconds:
+                    client, _ = idle.popleft()
+                    await self.__quit(client)
+                if not idle:
+                    del self.__idle[key]
+            # 密码更换后旧凭据不会再被使用，清理其记录
+            for key in [key for key, count in self.__active.items() if count == 0 and key not in self.__idle]:
+                del self.__active[key]
+                self.__semaphores.pop(key, None)
+
+    @staticmethod
+    async def __quit(client: aiosmtplib.SMTP):
+        try:
+            await client.quit()
+        except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError):
+            client.close()
+
+    def start(self):
+        self.__cleanup_task = asyncio.create_task(self.__task_cleanup())
+
+    async def close(self):
+        if self.__cleanup_task is not None:
+            self.__cleanup_task.cancel()
+            self.__cleanup_task = None
+        idle, self.__idle = self.__idle, {}
+        await asyncio.gather(*(self.__quit(client) for clients in idle.values() for client, _ in clients))
@@ -16,3 +16,6 @@ class AdapterBase:
 
     def stop(self):
         pass
+
+    def main_stop(self):
+        pass
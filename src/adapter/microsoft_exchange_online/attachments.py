@@ -0,0 +1,52 @@
+from typing import NamedTuple
+from email.message import Message
+
+
+class Attachment(NamedTuple):
+    name: str
+    content_type: str
+    content: bytes  # 解码后的附件内容，较大的附件可能是临时文件的只读`mmap`
+    is_inline: bool
+    content_id: str | None
+
+
+def __attachment_parts(message: Message) -> list[tuple[Message, Message]]:
+    """找出可以单独上传的附件及其所在的multipart父节点"""
+    parts = []
+    for parent in message.walk():
+        if not parent.is_multipart():
+            continue
+        for part in parent.get_payload():
+            if part.is_multipart() or part.get_content_maintype() == 'message':
+                continue
+            if part.get_content_disposition() in ('attachment', 'inline') and (part.get_filename() or part['Content-ID']):
+                parts.append((parent, part))
+    return parts
+
+
+def split_large_attachments(message: Message, size: int, max_size: int) -> tuple[bytes, list[Attachment]]:
+    """
+    从邮件中按从大到小的顺序移除附件，直到剩余的MIME内容不超过`max_size`字节。
+
+    `size`为原始邮件的大小。返回剩余的MIME内容和被移除的附件。会修改传入的`message`。
+    移除所有可移除的附件后仍然超出大小限制时抛出`552`异常。
+    """
+    parts = sorted(__attachment_parts(message), key=lambda x: len(x[1].get_payload()), reverse=True)
+    removed = []
+    for parent, part in parts:
+        if size <= max_size:
+            break
+        size -= len(part.get_payload())
+        parent.get_payload().remove(part)
+        content_id = part['Content-ID']
+        removed.append(Attachment(
+            name=part.get_filename() or 'attachment',
+            content_type=part.get_content_type(),
+            content=part.get_payload(decode=True) or b'',
+            is_inline=part.get_content_disposition() == 'inline',
+            content_id=content_id.strip('<> ') if content_id else None
+        ))
+    mime = message.as_bytes()
+    if len(mime) > max_size:
+        raise Exception(f'552 Message body is too large to send ({len(mime)} bytes without attachments)')
+    return mime, removed
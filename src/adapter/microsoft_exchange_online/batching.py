@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class RequestBatcher:
+    """
+    Graph API请求的微批处理器。
+
+    并发提交的请求在`linger_seconds`内被合并为一批，交给`send_batch`通过一次`$batch`请求发送。
+    一批最多`max_size`个请求，请求体总大小不超过`max_bytes`，达到任一上限时立即发送。
+    `send_batch`接收请求列表，按相同顺序返回每个请求对应的SMTP响应或异常。
+    """
+
+    def __init__(self, send_batch: Callable[[list[dict]], Awaitable[list[str | Exception]]],
+                 linger_seconds: float = 0.01, max_size: int = 20, max_bytes: int = 3 * 1024 * 1024):
+        self.__send_batch = send_batch
+        self.__linger_seconds = linger_seconds
+        self.__max_size = min(max(max_size, 1), 20)  # Graph API限制每批最多20个请求
+        self.__max_bytes = max_bytes
+        self.__pending: list[tuple[dict, asyncio.Future]] = []
+        self.__pending_bytes = 0
+        self.__timer: asyncio.TimerHandle | None = None
+        self.__tasks: set[asyncio.Task] = set()
+
+    async def submit(self, request: dict, size: int) -> str:
+        """提交一个请求，`size`为其请求体的大小，返回此请求的SMTP响应"""
+        if self.__pending and self.__pending_bytes + size > self.__max_bytes:
+            self.__flush()
+        future = asyncio.get_running_loop().create_future()
+        self.__pending.append((request, future))
+        self.__pending_bytes += size
+        if len(self.__pending) >= self.__max_size:
+            self.__flush()
+        elif self.__timer is None:
+            self.__timer = asyncio.get_running_loop().call_later(self.__linger_seconds, self.__flush)
+        return await asyncio.shield(future)
+
+    def __flush(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        batch, self.__pending, self.__pending_bytes = self.__pending, [], 0
+        if batch:
+            task = asyncio.create_task(self.__run(batch))
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    async def __run(self, batch: list[tuple[dict, asyncio.Future]]):
+        logger.debug('Sending %d request(s) in one batch...', len(batch))
+        try:
+            results = await self.__send_batch([request for request, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+                # 调用者可能已经被取消，标记异常已被取走
+                future.exception()
+            else:
+                future.set_result(result)
+
+    async def stop(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        for task in self.__tasks:
+            task.cancel()
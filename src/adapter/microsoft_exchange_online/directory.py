@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import aiohttp
+from typing import Awaitable, Callable
+from adapter.microsoft_exchange_online.registry import SenderRegistry
+
+logger = logging.getLogger(__name__)
+
+GRAPH_USERS_SELECT = 'id,mail,proxyAddresses'
+
+
+class DirectorySync:
+    """
+    Exchange Online 用户目录同步。
+
+    首次启动时分页拉取全部用户的邮件地址，之后通过`/users/delta`增量查询保持缓存最新。
+    同步结果会保存到本地快照文件，重启后从快照和增量链接继续同步，不需要重新全量拉取。
+    """
+
+    def __init__(self, registry: SenderRegistry, graph_get: Callable[[str], Awaitable[dict]],
+                 graph_base_url: str = 'https://graph.microsoft.com',
+                 snapshot_path: str = '', interval_seconds: float = 300):
+        self.__registry = registry
+        self.__graph_get = graph_get
+        self.__graph_base_url = graph_base_url.rstrip('/')
+        self.__snapshot_path = snapshot_path
+        self.__interval_seconds = interval_seconds
+        self.__users: dict[str, list[str]] = {}  # 用户ID -> 邮件地址列表
+        self.__delta_link: str | None = None
+        self.__task: asyncio.Task | None = None
+
+    @staticmethod
+    def __get_addresses(user: dict) -> list[str]:
+        addresses = set()
+        if user.get('mail'):
+            addresses.add(SenderRegistry.normalize(user['mail']))
+        for proxy_address in user.get('proxyAddresses') or []:
+            if proxy_address.lower().startswith('smtp:'):
+                addresses.add(SenderRegistry.normalize(proxy_address[5:]))
+        return sorted(addresses)
+
+    def __set_user(self, user_id: str, addresses: list[str]):
+        for addr in self.__users.get(user_id, []):
+            self.__registry.discard(addr)
+        self.__users[user_id] = addresses
+        self.__registry.update(addresses)
+
+    def __remove_user(self, user_id: str):
+        for addr in self.__users.pop(user_id, []):
+            self.__registry.discard(addr)
+
+    def __apply_delta_item(self, user: dict):
+        if '@removed' in user:
+            self.__remove_user(user['id'])
+            return
+        if 'mail' not in user and 'proxyAddresses' not in user:
+            return
+        addresses = self.__get_addresses(user)
+        if 'proxyAddresses' not in user:
+            # 增量结果只包含变化的属性，没有`proxyAddresses`时保留已知的其他地址
+            addresses = sorted(set(self.__users.get(user['id'], [])).union(addresses))
+        self.__set_user(user['id'], addresses)
+
+    def __load_snapshot(self) -> bool:
+        if not self.__snapshot_path or not os.path.exists(self.__snapshot_path):
+            return False
+        try:
+            with open(self.__snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            users = snapshot['users']
+            delta_link = snapshot['delta_link']
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'Ignoring unreadable directory snapshot `{self.__snapshot_path}`: {e}')
+            return False
+        for user_id, addresses in users.items():
+            self.__set_user(user_id, addresses)
+        self.__delta_link = delta_link
+        logger.info(f'Loaded {len(users)} user(s) from directory snapshot.')
+        return True
+
+    def __save_snapshot(self):
+        if not self.__snapshot_path:
+            return
+        directory = os.path.dirname(self.__snapshot_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.__snapshot_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'saved_at': time.time(), 'delta_link': self.__delta_link, 'users': self.__users}, f)
+        os.replace(tmp_path, self.__snapshot_path)
+
+    async def __full_sync(self):
+        """分页拉取全部用户，并记录此时的增量链接"""
+        # 先获取最新的增量链接再全量拉取，拉取期间发生的变更会在下次增量同步时重放
+        response = await self.__graph_get(
+            f'{self.__graph_base_url}/v1.0/users/delta?$select={GRAPH_USERS_SELECT}&$deltatoken=latest'
+        )
+        delta_link = response['@odata.deltaLink']
+        # 拉取期间发信仍在进行，先收集完整结果，再一次性替换注册表中的内容，中间不能让出事件循环
+        users: dict[str, list[str]] = {}
+        url = f'{self.__graph_base_url}/v1.0/users?$select={GRAPH_USERS_SELECT}&$top=999'
+        pages = 0
+        while url:
+            response = await self.__graph_get(url)
+            for user in response['value']:
+                users[user['id']] = self.__get_addresses(user)
+            url = response.get('@odata.nextLink')
+            pages += 1
+        for user_id in [user_id for user_id in self.__users if user_id not in users]:
+            self.__remove_user(user_id)
+        for user_id, addresses in users.items():
+            self.__set_user(user_id, addresses)
+        self.__delta_link = delta_link
+        logger.info(f'Full directory sync finished. {len(self.__users)} user(s) in {pages} page(s).')
+
+    async def __delta_sync(self) -> int:
+        """从上次的增量链接开始同步变更，返回变更的用户数量"""
+        url = self.__delta_link
+        changes = 0
+        while True:
+            response = await self.__graph_get(url)
+            for user in response['value']:
+                self.__apply_delta_item(user)
+            changes += len(response['value'])
+            if next_link := response.get('@odata.nextLink'):
+                url = next_link
+            else:
+                self.__delta_link = response['@odata.deltaLink']
+                return changes
+
+    async def sync(self):
+        if self.__delta_link is None:
+            await self.__full_sync()
+        else:
+            try:
+                changes = await self.__delta_sync()
+                logger.debug(f'Delta directory sync finished. {changes} change(s).')
+                if changes == 0:
+                    return
+            except aiohttp.ClientResponseError as e:
+                if e.status not in (400, 410):
+                    raise
+                # 增量链接已过期，重新全量同步
+                logger.warning(f'Directory delta link expired ({e.status}). Running full sync...')
+                self.__delta_link = None
+                await self.__full_sync()
+        await asyncio.to_thread(self.__save_snapshot)
+
+    async def __task_sync(self):
+        while True:
+            await asyncio.sleep(self.__interval_seconds)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f'Directory sync failed: {e}')
+
+    async def start(self):
+        await asyncio.to_thread(self.__load_snapshot)
+        await self.sync()
+        logger.info(f'Directory synced. Number of known addresses: {len(self.__registry)}.')
+        if self.__interval_seconds > 0:
+            self.__task = asyncio.create_task(self.__task_sync())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
@@ -0,0 +1,116 @@
+import json
+import time
+import bisect
+import hashlib
+import logging
+from contextlib import contextmanager
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+# 说明代理邮箱自身的发信额度已用尽的Graph错误码，出现时暂时不再使用此邮箱
+MAILBOX_QUOTA_ERRORS = {'ErrorQuotaExceeded', 'ErrorMessageSubmissionBlocked'}
+
+
+def parse_error_code(text: str) -> str | None:
+    """从Graph API的错误响应中取出错误码"""
+    try:
+        error = json.loads(text).get('error')
+    except (ValueError, AttributeError):
+        return None
+    return error.get('code') if isinstance(error, dict) else None
+
+
+class SenderMailboxPool:
+    """
+    实际代理发信的邮箱(代理邮箱)。
+
+    每封邮件按发信地址选择一个代理邮箱，同一封邮件的所有请求都使用此邮箱：
+      - `hash`: 一致性哈希。同一发信地址总是使用同一个代理邮箱，增减代理邮箱时只有约`1/N`的发信地址改变映射。
+      - `least_loaded`: 选择正在发送的邮件最少的代理邮箱。
+    被限流或额度用尽的代理邮箱会在`suspend()`指定的时间内退出轮换，一致性哈希时其发信地址暂时由环上的下一个邮箱接管。
+    所有代理邮箱都退出轮换时，选择最早恢复的邮箱，由速率限制负责等待。
+    """
+
+    def __init__(self, mailboxes: list[str], routing: str = 'hash', cooldown_seconds: float = 60,
+                 virtual_nodes: int = 100):
+        if routing not in ('hash', 'least_loaded'):
+            raise ValueError(f'Unknown sender routing `{routing}`. Expected `hash` or `least_loaded`.')
+        self.mailboxes: list[str] = list(dict.fromkeys(mailbox.strip() for mailbox in mailboxes if mailbox.strip()))
+        if not self.mailboxes:
+            raise ValueError('At least one sender mailbox is required.')
+        self.routing = routing
+        self.cooldown_seconds = cooldown_seconds
+        self.__in_flight: dict[str, int] = {mailbox: 0 for mailbox in self.mailboxes}
+        self.__suspended_until: dict[str, float] = {}
+        self.__next = 0  # `least_loaded`负载相同时轮流选择
+        ring = sorted((self.__hash(f'{mailbox.lower()}#{i}'), mailbox)
+                      for mailbox in self.mailboxes for i in range(virtual_nodes))
+        self.__ring_hashes = [point for point, _ in ring]
+        self.__ring_mailboxes = [mailbox for _, mailbox in ring]
+
+    @staticmethod
+    def __hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def __len__(self) -> int:
+        return len(self.mailboxes)
+
+    @property
+    def primary(self) -> str:
+        return self.mailboxes[0]
+
+    @property
+    def suspended_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for until in self.__suspended_until.values() if until > now)
+
+    def available(self, mailbox: str, now: float | None = None) -> bool:
+        return self.__suspended_until.get(mailbox, 0) <= (time.monotonic() if now is None else now)
+
+    def pick(self, key: str) -> str:
+        """为发信地址`key`选择代理邮箱"""
+        if len(self.mailboxes) == 1:
+            return self.primary
+        now = time.monotonic()
+        if self.routing == 'hash':
+            candidates = self.__ring_order(key.strip().lower())
+        else:
+            # 负载相同时轮流选择，避免总是选中列表中的第一个
+            self.__next = (self.__next + 1) % len(self.mailboxes)
+            candidates = sorted(self.mailboxes[self.__next:] + self.mailboxes[:self.__next],
+                                key=self.__in_flight.__getitem__)
+        for mailbox in candidates:
+            if self.available(mailbox, now):
+                return mailbox
+        return min(self.mailboxes, key=lambda mailbox: self.__suspended_until.get(mailbox, 0))
+
+    def __ring_order(self, key: str) -> Iterator[str]:
+        """从`key`在哈希环上的位置开始，按顺时针顺序依次给出各个代理邮箱"""
+        start = bisect.bisect(self.__ring_hashes, self.__hash(key))
+        seen = set()
+        for i in range(len(self.__ring_mailboxes)):
+            mailbox = self.__ring_mailboxes[(start + i) % len(self.__ring_mailboxes)]
+            if mailbox not in seen:
+                seen.add(mailbox)
+                yield mailbox
+
+    @contextmanager
+    def route(self, key: str) -> Iterator[str]:
+        """选择代理邮箱，并在发送期间计入此邮箱的负载"""
+        mailbox = self.pick(key)
+        self.__in_flight[mailbox] += 1
+        try:
+            yield mailbox
+        finally:
+            self.__in_flight[mailbox] -= 1
+
+    def suspend(self, mailbox: str, seconds: float | None = None):
+        """让代理邮箱在`seconds`秒(未指定时为`cooldown_seconds`)内退出轮换"""
+        if mailbox not in self.__in_flight or len(self.mailboxes) == 1:
+            return
+        seconds = seconds or self.cooldown_seconds
+        now = time.monotonic()
+        if self.available(mailbox, now):
+            logger.warning('Sender mailbox `%s` is taken out of rotation for %.0fs.', mailbox, seconds)
+        self.__suspended_until[mailbox] = max(self.__suspended_until.get(mailbox, 0), now + seconds)
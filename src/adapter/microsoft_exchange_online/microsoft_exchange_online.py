@@ -1,19 +1,39 @@
 import os
+import json
+import time
 import yaml
-import shlex
 import base64
 import asyncio
 import aiohttp
 import logging
+import multiprocessing as mp
+from multiprocessing.managers import SyncManager
 from pydantic import BaseModel
 from aiosmtpd.smtp import Envelope
-from email import message_from_bytes
-from email.utils import parseaddr
-from email.header import decode_header, make_header
 from datetime import datetime, timedelta
+from util import MailContext, parse_message, spill_bytes, release
+from config import SMTP, CONFIG_PATH
+from metrics import STAGE_SECONDS, gauge
 from adapter.base import AdapterBase
+from adapter.microsoft_exchange_online.registry import SenderRegistry
+from adapter.microsoft_exchange_online.directory import DirectorySync
+from adapter.microsoft_exchange_online.payload import base64_stream, base64_length
+from adapter.microsoft_exchange_online.batching import RequestBatcher
+from adapter.microsoft_exchange_online.ratelimit import AdaptiveRateLimiter, parse_retry_after
+from adapter.microsoft_exchange_online.mailboxes import SenderMailboxPool, MAILBOX_QUOTA_ERRORS, parse_error_code
+from adapter.microsoft_exchange_online.attachments import Attachment, split_large_attachments
+from adapter.microsoft_exchange_online.provisioning import ProvisioningBatcher, PropagationEstimator
+from adapter.microsoft_exchange_online.powershell import (
+    PowerShellWorkerPool, PowerShellWorkerError, PowerShellCommandError
+)
 
 logger = logging.getLogger(__name__)
+# 后台续期token的最小间隔(秒)
+TOKEN_RENEWAL_MIN_INTERVAL_SECONDS = 30
+SENDERS = gauge('smtp_relayer_exchange_known_senders', 'Sender addresses known to have a shared mailbox.')
+PENDING_SENDERS = gauge('smtp_relayer_exchange_pending_senders', 'Sender addresses being created.')
+SUSPENDED_MAILBOXES = gauge('smtp_relayer_exchange_suspended_sender_mailboxes',
+                            'Sender mailboxes taken out of rotation after throttling or quota errors.')
 
 
 class Config(BaseModel):
@@ -22,18 +42,52 @@ class Config(BaseModel):
     client_id: str
     client_secret: str
     sender: str
+    sender_routing: str = 'hash'
+    sender_cooldown_seconds: float = 60
+    graph_base_url: str = 'https://graph.microsoft.com'
+    login_base_url: str = 'https://login.microsoftonline.com'
     certificate_path: str = ''
     certificate_b64: str = ''
     certificate_password: str = ''
     powershell_cmd: str = 'pwsh'
+    powershell_workers: int = 2
+    powershell_startup_timeout_seconds: int = 180
+    powershell_command_timeout_seconds: int = 300
+    powershell_health_check_interval_seconds: int = 300
+    provisioning_batch_window_ms: int = 1000
+    provisioning_batch_max_size: int = 20
+    readiness_poll_interval_seconds: float = 2
+    readiness_poll_max_interval_seconds: float = 30
+    readiness_timeout_seconds: float = 300
     initial_user_waiting_seconds: int = 30
+    http_connection_limit: int = 100
+    http_connection_limit_per_host: int = 50
+    http_keepalive_timeout_seconds: float = 60
+    http_dns_cache_ttl_seconds: int = 300
+    http_connect_timeout_seconds: float = 10
+    http_total_timeout_seconds: float = 300
+    directory_sync_interval_seconds: int = 300
+    directory_snapshot_path: str = '../data/microsoft_exchange_online_directory.json'
+    large_message_threshold_bytes: int = 3 * 1024 * 1024
+    large_message_parse_concurrency: int = 1
+    upload_chunk_size_bytes: int = 10 * 320 * 1024
+    upload_concurrency: int = 4
+    batch_max_size: int = 20
+    batch_linger_ms: int = 10
+    batch_max_message_bytes: int = 128 * 1024
+    mailbox_rate_limit_per_second: float = 10
+    mailbox_rate_limit_max_per_second: float = 16
+    tenant_rate_limit_per_second: float = 50
+    tenant_rate_limit_max_per_second: float = 200
+    rate_limit_increase_per_second: float = 1
+    rate_limit_decrease_factor: float = 0.5
 
 
 class Adapter(AdapterBase):
     def __init__(self):
         super().__init__()
         self.name = 'microsoft_exchange_online'
-        with open('../config/config.yaml', 'r', encoding='utf-8') as f:
+        with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
             self.CONFIG = Config(
                 **yaml.safe_load(f)[self.name]
             )
@@ -58,125 +112,529 @@ class Adapter(AdapterBase):
             with open('../cert.pfx', 'wb') as f:
                 f.write(base64.b64decode(self.CONFIG.certificate_b64))
             self.CONFIG.certificate_path = '../cert.pfx'
+        self.CONFIG.graph_base_url = self.CONFIG.graph_base_url.rstrip('/')
+        self.CONFIG.login_base_url = self.CONFIG.login_base_url.rstrip('/')
 
+        self.__session: aiohttp.ClientSession | None = None
         self.__access_token: str | None = None
         self.__access_token_expiring_time: datetime | None = None
-        self.__existing_users: list = []  # 已有用户的缓存
-        self.__creating_users: list = []
-
-    async def __check_access_token(self):
-        # 当token不存在或者即将过期，更新token
-        if self.__access_token is None or self.__access_token_expiring_time - datetime.now() < timedelta(minutes=5):
-            url = f"https://login.microsoftonline.com/{self.CONFIG.tenant_id}/oauth2/v2.0/token"
-            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-            data = {
-                'client_id': self.CONFIG.client_id,
-                'scope': 'https://graph.microsoft.com/.default',
-                'client_secret': self.CONFIG.client_secret,
-                'grant_type': 'client_credentials'
-            }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, data=data) as response:
+        self.__access_token_lifetime = timedelta(hours=1)
+        self.__access_token_renewing: asyncio.Task | None = None
+        self.__access_token_renewal_task: asyncio.Task | None = None
+        self.__senders = SenderRegistry()  # 已有用户的缓存
+        # 实际代理发信的邮箱，`sender`中以逗号分隔多个
+        self.__mailboxes = SenderMailboxPool(
+            self.CONFIG.sender.split(','),
+            routing=self.CONFIG.sender_routing,
+            cooldown_seconds=self.CONFIG.sender_cooldown_seconds
+        )
+        # 完整解析大邮件时的临时内存占用是邮件大小的数倍，限制同时解析的数量
+        self.__large_message_parse_semaphore = asyncio.Semaphore(max(self.CONFIG.large_message_parse_concurrency, 1))
+        self.__multiprocessing_manager: SyncManager | None = None
+        self.__directory = DirectorySync(
+            registry=self.__senders,
+            graph_get=self.__graph_get,
+            snapshot_path=self.CONFIG.directory_snapshot_path,
+            graph_base_url=self.CONFIG.graph_base_url,
+            interval_seconds=self.CONFIG.directory_sync_interval_seconds
+        )
+        powershell_cmd = [
+            self.CONFIG.powershell_cmd,
+            '-NoLogo', '-NoProfile', '-NonInteractive',
+            '-File', 'adapter/microsoft_exchange_online/powershell-worker.ps1',
+            '-AppId', self.CONFIG.client_id,
+            '-Organization', self.CONFIG.organization,
+            '-CertificatePath', self.CONFIG.certificate_path
+        ]
+        if self.CONFIG.certificate_password:
+            powershell_cmd.extend(['-CertificatePassword', self.CONFIG.certificate_password])
+        self.__powershell = PowerShellWorkerPool(
+            size=self.CONFIG.powershell_workers,
+            cmd=powershell_cmd,
+            startup_timeout=self.CONFIG.powershell_startup_timeout_seconds,
+            command_timeout=self.CONFIG.powershell_command_timeout_seconds,
+            health_check_interval=self.CONFIG.powershell_health_check_interval_seconds
+        )
+        self.__provisioning = ProvisioningBatcher(
+            create_batch=self.__create_users,
+            window_seconds=self.CONFIG.provisioning_batch_window_ms / 1000,
+            max_size=self.CONFIG.provisioning_batch_max_size
+        )
+        self.__propagation = PropagationEstimator(self.CONFIG.initial_user_waiting_seconds)
+        # 发信速率限制，分别针对每个发信邮箱和整个租户，速率为0时不限制
+        self.__mailbox_limiters: dict[str, AdaptiveRateLimiter] = {}
+        self.__tenant_limiter = self.__create_limiter(
+            'tenant', self.CONFIG.tenant_rate_limit_per_second, self.CONFIG.tenant_rate_limit_max_per_second
+        )
+        self.__batcher = RequestBatcher(
+            send_batch=self.__send_batch,
+            linger_seconds=self.CONFIG.batch_linger_ms / 1000,
+            max_size=self.CONFIG.batch_max_size
+        )
+
+    async def __renew_access_token(self):
+        """向Microsoft Entra请求新的token，失败时抛出451临时错误"""
+        url = f"{self.CONFIG.login_base_url}/{self.CONFIG.tenant_id}/oauth2/v2.0/token"
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        data = {
+            'client_id': self.CONFIG.client_id,
+            'scope': f'{self.CONFIG.graph_base_url}/.default',
+            'client_secret': self.CONFIG.client_secret,
+            'grant_type': 'client_credentials'
+        }
+        try:
+            with STAGE_SECONDS.time(stage='token_refresh'):
+                async with self.__session.post(url, headers=headers, data=data) as response:
                     if response.status == 200:
                         json_response = await response.json()
                         self.__access_token = json_response['access_token']
-                        self.__access_token_expiring_time = datetime.now() + timedelta(
-                            seconds=json_response['expires_in'])
+                        self.__access_token_lifetime = timedelta(seconds=json_response['expires_in'])
+                        self.__access_token_expiring_time = datetime.now() + self.__access_token_lifetime
                         logger.info('Access token renewed.')
-                    else:
-                        logger.error(f"Failed to renew access token. Status code: {response.status}")
-                        error_message = await response.text()
-                        logger.error(f"Error message: {error_message}")
+                        return
+                    error_message = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error_message = repr(e)
+        logger.error(f"Failed to renew access token: {error_message}")
+        raise Exception(f'451 Failed to renew access token: {error_message}')
+
+    def __renew_access_token_single_flight(self) -> asyncio.Task:
+        # 同一时间只有一个刷新请求，并发的调用者共同等待它的结果
+        if self.__access_token_renewing is None or self.__access_token_renewing.done():
+            self.__access_token_renewing = asyncio.create_task(self.__renew_access_token())
+            # 无人等待时也要取走异常，避免`Task exception was never retrieved`警告
+            self.__access_token_renewing.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return self.__access_token_renewing
+
+    async def __get_access_token(self) -> str:
+        """获取可用的token。正常情况下token由后台任务提前续期，请求路径不会等待刷新"""
+        if self.__access_token is not None:
+            remaining = self.__access_token_expiring_time - datetime.now()
+            if remaining > min(timedelta(minutes=5), self.__access_token_lifetime / 4):
+                return self.__access_token
+            if remaining > timedelta(minutes=1):
+                # 即将过期但仍然可用，在后台刷新，本次请求继续使用当前token
+                self.__renew_access_token_single_flight()
+                return self.__access_token
+        await asyncio.shield(self.__renew_access_token_single_flight())
+        return self.__access_token
+
+    async def __task_renew_access_token(self):
+        """
+        在token过期前提前续期的后台任务。
+
+        通常提前10分钟续期；token有效期较短时提前有效期的一半，且两次续期至少间隔`TOKEN_RENEWAL_MIN_INTERVAL_SECONDS`秒，
+        避免有效期不超过10分钟时不停地请求token。
+        """
+        while True:
+            lead = min(timedelta(minutes=10), self.__access_token_lifetime / 2)
+            delay = (self.__access_token_expiring_time - datetime.now() - lead).total_seconds()
+            await asyncio.sleep(max(delay, TOKEN_RENEWAL_MIN_INTERVAL_SECONDS))
+            try:
+                await asyncio.shield(self.__renew_access_token_single_flight())
+            except Exception as e:
+                logger.error(f'Background access token renewal failed, retrying in 30s: {e}')
+                await asyncio.sleep(30)
 
     async def __check_users(self, user_name: str, user_addr: str):
-        # 当用户不存在时，创建用户的共享邮箱并分配`SendAs`权限
-        if user_addr not in self.__existing_users:
-            logger.info(f"New user found. Creating user `{user_addr}`...")
+        # 当用户不存在时，创建用户的共享邮箱并分配`SendAs`权限。
+        # 如果待创建的地址正在被其他任务创建，等待创建完毕后返回
+        if user_name == '':
+            user_name = user_addr.split('@')[0]
+        await self.__senders.ensure(user_addr, lambda: self.__provisioning.submit(user_addr, user_name))
+
+    async def __create_users(self, targets: list[tuple[str, str]]) -> dict[str, Exception | None]:
+        """在一个PowerShell会话中批量创建用户，整批只等待一次Exchange Online处理"""
+        for user_addr, user_name in targets:
+            logger.info(f"New user found. Creating user `{user_name} <{user_addr}>`...")
+        try:
+            with STAGE_SECONDS.time(stage='provisioning'):
+                results = await self.__powershell.call(
+                    'create_mailboxes',
+                    targets=[{'address': user_addr, 'name': user_name} for user_addr, user_name in targets],
+                    senders=self.__mailboxes.mailboxes
+                )
+        except (PowerShellCommandError, PowerShellWorkerError) as e:
+            logger.error(f'Failed to create users: {e}')
+            return {user_addr: RuntimeError(f'451 Failed to create user: {e}') for user_addr, _ in targets}
 
-            # 检查待创建的地址是否正在被其他任务创建，如果是的话，等待创建完毕后返回
-            if user_addr not in self.__creating_users:
-                self.__creating_users.append(user_addr)
+        errors: dict[str, Exception | None] = {}
+        for result in results if isinstance(results, list) else [results]:
+            if result['ok']:
+                logger.info(f'Created new user `{result["address"]}`.')
+                errors[result['address']] = None
             else:
-                while user_addr in self.__creating_users:
-                    await asyncio.sleep(1)
+                logger.error(f'Failed to create user `{result["address"]}`: {result["error"]}')
+                errors[result['address']] = RuntimeError(f'550 Failed to create user: {result["error"]}')
+        with STAGE_SECONDS.time(stage='propagation_wait'):
+            await self.__wait_until_ready([user_addr for user_addr, error in errors.items() if error is None])
+        return errors
+
+    async def __wait_until_ready(self, user_addrs: list[str]):
+        """Exchange Online 处理较慢，轮询等待新用户的`SendAs`权限生效，超时后不再等待"""
+        if not user_addrs:
+            return
+        created_at = time.monotonic()
+        initial_delay = self.__propagation.initial_delay
+        logger.info(f'Waiting {initial_delay:.1f}s for Exchange Online before checking new users...')
+        await asyncio.sleep(initial_delay)
+        pending = set(user_addrs)
+        interval = self.CONFIG.readiness_poll_interval_seconds
+        while True:
+            try:
+                results = await self.__powershell.call('check_mailboxes', addresses=sorted(pending),
+                                                       senders=self.__mailboxes.mailboxes)
+            except (PowerShellCommandError, PowerShellWorkerError) as e:
+                logger.warning(f'Failed to check new users: {e}')
+                results = []
+            elapsed = time.monotonic() - created_at
+            for result in results if isinstance(results, list) else [results]:
+                if result['ready'] and result['address'] in pending:
+                    pending.discard(result['address'])
+                    self.__propagation.record(elapsed)
+                    logger.info(f'User `{result["address"]}` is ready after {elapsed:.1f}s.')
+            if not pending:
+                return
+            if elapsed >= self.CONFIG.readiness_timeout_seconds:
+                logger.warning(f'Users are still not ready after {elapsed:.0f}s, sending anyway: '
+                               f'{", ".join(sorted(pending))}')
                 return
+            await asyncio.sleep(min(interval, self.CONFIG.readiness_timeout_seconds - elapsed))
+            interval = min(interval * 2, self.CONFIG.readiness_poll_max_interval_seconds)
 
-            if user_name == '':
-                user_name = user_addr.split('@')[0]
-            cmd = [
-                self.CONFIG.powershell_cmd,
-                '-File', 'adapter/microsoft_exchange_online/init-new-user.ps1',
-                '-AppId', self.CONFIG.client_id,
-                '-Organization', self.CONFIG.organization,
-                '-CertificatePath', self.CONFIG.certificate_path,
-                '-TargetAddress', user_addr,
-                '-TargetName', user_name,
-                '-SenderAddress', self.CONFIG.sender
-            ]
-            if self.CONFIG.certificate_password:
-                cmd.extend(['-CertificatePassword', self.CONFIG.certificate_password])
-            cmd_str = ' '.join(shlex.quote(x) for x in cmd)
-            logger.debug(f'Running command: `{cmd_str}`')
-
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+    def __create_session(self) -> aiohttp.ClientSession:
+        # 所有请求共用一个会话，复用到Graph API的长连接，避免每次请求都重新进行TCP和TLS握手
+        connector = aiohttp.TCPConnector(
+            limit=self.CONFIG.http_connection_limit,
+            limit_per_host=self.CONFIG.http_connection_limit_per_host,
+            keepalive_timeout=self.CONFIG.http_keepalive_timeout_seconds,
+            ttl_dns_cache=self.CONFIG.http_dns_cache_ttl_seconds
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=self.CONFIG.http_total_timeout_seconds,
+            connect=self.CONFIG.http_connect_timeout_seconds
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def __graph_get(self, url: str) -> dict:
+        headers = {'Authorization': f'Bearer {await self.__get_access_token()}'}
+        async with self.__session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    @staticmethod
+    def __graph_error(status: int, text: str, action: str, retry_after: float | None = None) -> Exception:
+        # 限流、代理邮箱额度用尽和服务端错误可以稍后重试，其他错误视为永久失败
+        if status == 429 or status >= 500 or parse_error_code(text) in MAILBOX_QUOTA_ERRORS:
+            if retry_after:
+                return Exception(f'451 {action}, retry after {retry_after:.0f}s: {text}')
+            return Exception(f'451 {action}: {text}')
+        return Exception(f'550 {action}: {text}')
+
+    def __create_limiter(self, name: str, rate: float, max_rate: float) -> AdaptiveRateLimiter | None:
+        if rate <= 0:
+            return None
+        return AdaptiveRateLimiter(
+            name=name,
+            rate=rate,
+            max_rate=max_rate,
+            increase_per_second=self.CONFIG.rate_limit_increase_per_second,
+            decrease_factor=self.CONFIG.rate_limit_decrease_factor
+        )
+
+    def __mailbox_limiter(self, mailbox: str) -> AdaptiveRateLimiter | None:
+        """邮箱的速率限制，`mailbox_rate_limit_per_second`为0时为`None`"""
+        key = mailbox.lower()
+        if key not in self.__mailbox_limiters:
+            self.__mailbox_limiters[key] = self.__create_limiter(
+                mailbox, self.CONFIG.mailbox_rate_limit_per_second, self.CONFIG.mailbox_rate_limit_max_per_second
             )
-            while True:
-                line = await process.stdout.readline()
-                if not line:
-                    break
-                logger.debug(f"init-new-user.ps1 OUTPUT: {line.decode().strip()}")
-
-            await process.wait()
-            logger.debug(f"init-new-user.ps1 EXIT CODE: {process.returncode}")
-            if process.returncode != 0:
-                error_message = await process.stderr.read()
-                logger.error(f"init-new-user.ps1 ERROR: {error_message.decode()}")
-                raise RuntimeError(f"550 Failed to create user: {error_message}")
-            else:
-                logger.info(f'Created new user `{user_name} <{user_addr}>`.')
-                self.__existing_users.append(user_addr)
-                self.__creating_users.remove(user_addr)
-                logger.info(f'Waiting {self.CONFIG.initial_user_waiting_seconds}s for Exchange Online...')
-                await asyncio.sleep(self.CONFIG.initial_user_waiting_seconds)  # Exchange Online 处理较慢，需要等待
+        return self.__mailbox_limiters[key]
 
-    async def start(self):
-        # 初始化适配器，缓存已有的用户列表，不重复创建用户
-        await self.__check_access_token()
-        url = 'https://graph.microsoft.com/v1.0/users'
+    def __limiters(self, mailbox: str) -> list[AdaptiveRateLimiter]:
+        return [limiter for limiter in (self.__mailbox_limiter(mailbox), self.__tenant_limiter) if limiter is not None]
+
+    async def __acquire_rate(self, mailbox: str, count: int = 1):
+        """等待发信速率限制放行`count`个请求"""
+        with STAGE_SECONDS.time(stage='rate_limit_wait'):
+            for limiter in self.__limiters(mailbox):
+                await limiter.acquire(count)
+
+    def __report_status(self, mailbox: str, status: int, retry_after: float | None = None, text: str = ''):
+        """
+        根据响应状态调整发信速率。
+
+        `429`说明单个邮箱的请求过多，只降低此邮箱的速率；`503`说明服务整体繁忙，同时降低租户的速率。
+        邮箱被限流或额度用尽时，还会让它暂时退出代理邮箱的轮换。
+        """
+        limiters = self.__limiters(mailbox)
+        if status == 429 or (status >= 400 and parse_error_code(text) in MAILBOX_QUOTA_ERRORS):
+            self.__mailboxes.suspend(mailbox, retry_after)
+        if status == 429:
+            # 未限制单个邮箱的速率时，不因为某个邮箱被限流而降低租户的速率
+            if (mailbox_limiter := self.__mailbox_limiter(mailbox)) is not None:
+                mailbox_limiter.on_throttled(retry_after)
+        elif status == 503:
+            for limiter in limiters:
+                limiter.on_throttled(retry_after)
+        elif 200 <= status < 300:
+            for limiter in limiters:
+                limiter.on_success()
+
+    async def __add_attachment(self, message_url: str, attachment: Attachment, semaphore: asyncio.Semaphore):
+        """向草稿添加附件。小附件直接上传，超过3MB的附件通过上传会话分块上传"""
+        try:
+            async with semaphore:
+                await self.__upload_attachment(message_url, attachment)
+        finally:
+            release(attachment.content)
+
+    async def __upload_attachment(self, message_url: str, attachment: Attachment):
+        headers = {'Authorization': f'Bearer {await self.__get_access_token()}'}
+        size = len(attachment.content)
+        if size < 3 * 1024 * 1024:
+            data = {
+                '@odata.type': '#microsoft.graph.fileAttachment',
+                'name': attachment.name,
+                'contentType': attachment.content_type,
+                'contentBytes': base64.b64encode(attachment.content).decode('ascii'),
+                'isInline': attachment.is_inline
+            }
+            if attachment.content_id:
+                data['contentId'] = attachment.content_id
+            async with self.__session.post(f'{message_url}/attachments', headers=headers, json=data) as response:
+                if response.status != 201:
+                    raise self.__graph_error(response.status, await response.text(),
+                                             f'Failed to add attachment `{attachment.name}`')
+            return
+
+        data = {'AttachmentItem': {
+            'attachmentType': 'file',
+            'name': attachment.name,
+            'size': size,
+            'contentType': attachment.content_type,
+            'isInline': attachment.is_inline
+        }}
+        if attachment.content_id:
+            data['AttachmentItem']['contentId'] = attachment.content_id
+        async with self.__session.post(f'{message_url}/attachments/createUploadSession',
+                                       headers=headers, json=data) as response:
+            if response.status != 201:
+                raise self.__graph_error(response.status, await response.text(),
+                                         f'Failed to create upload session for `{attachment.name}`')
+            upload_url = (await response.json())['uploadUrl']
+        # 上传地址自带授权，不能再携带Authorization头；同一附件的分块需要按顺序上传
+        chunk_size = max(self.CONFIG.upload_chunk_size_bytes // (320 * 1024), 1) * 320 * 1024
+        with memoryview(attachment.content) as view:
+            for start in range(0, size, chunk_size):
+                chunk = view[start:start + chunk_size]
+                headers = {
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Range': f'bytes {start}-{start + len(chunk) - 1}/{size}'
+                }
+                async with self.__session.put(upload_url, headers=headers, data=chunk) as response:
+                    if response.status not in (200, 201):
+                        raise self.__graph_error(response.status, await response.text(),
+                                                 f'Failed to upload attachment `{attachment.name}`')
+
+    async def __send_large_mail(self, envelope: Envelope, mailbox: str) -> str:
+        """
+        通过代理邮箱`mailbox`发送超过`sendMail`大小限制的邮件。
+
+        先移除较大的附件，用剩余的MIME内容创建草稿，再把附件逐个添加到草稿中，最后发送草稿。
+        多个附件并行上传，任一步骤失败时删除草稿。
+        """
+        def split() -> tuple[bytes, list[Attachment]]:
+            mime, attachments = split_large_attachments(parse_message(envelope.content), len(envelope.content),
+                                                        self.CONFIG.large_message_threshold_bytes)
+            # 附件在上传期间一直保留，较大的附件与接收时一样写入临时文件
+            return mime, [attachment._replace(content=spill_bytes(attachment.content,
+                                                                  SMTP.data_spill_threshold_bytes,
+                                                                  SMTP.data_spill_dir))
+                          for attachment in attachments]
+
+        async with self.__large_message_parse_semaphore:
+            mime, attachments = await asyncio.to_thread(split)
+        logger.info('Mail is too large for sendMail, uploading %d attachment(s) separately...', len(attachments))
+        messages_url = f'{self.CONFIG.graph_base_url}/v1.0/users/{mailbox}/messages'
+        await self.__acquire_rate(mailbox)
         headers = {
-            'Authorization': f'Bearer {self.__access_token}',
-            'Content-Type': 'application/json'
+            'Authorization': f'Bearer {await self.__get_access_token()}',
+            'Content-Type': 'text/plain',
+            'Content-Length': str(base64_length(len(mime)))
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                if response.status == 200:
-                    json_response = await response.json()
-                    self.__existing_users = [user['mail'] for user in json_response['value']]
-                    logger.info(f"Initialized OK. Number of existing users: {len(self.__existing_users)}.")
-                else:
-                    response.raise_for_status()
+        async with self.__session.post(messages_url, headers=headers, data=base64_stream(mime)) as response:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if response.status != 201:
+                text = await response.text()
+                self.__report_status(mailbox, response.status, retry_after, text)
+                raise self.__graph_error(response.status, text, 'Failed to create draft', retry_after)
+            self.__report_status(mailbox, response.status)
+            message_url = f'{messages_url}/{(await response.json())["id"]}'
+
+        try:
+            semaphore = asyncio.Semaphore(max(self.CONFIG.upload_concurrency, 1))
+            tasks = [asyncio.create_task(self.__add_attachment(message_url, attachment, semaphore))
+                     for attachment in attachments]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            await self.__acquire_rate(mailbox)
+            headers = {'Authorization': f'Bearer {await self.__get_access_token()}'}
+            async with self.__session.post(f'{message_url}/send', headers=headers) as response:
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if response.status == 202:
+                    self.__report_status(mailbox, response.status)
+                    return '250 Message accepted for delivery'
+                text = await response.text()
+                self.__report_status(mailbox, response.status, retry_after, text)
+                raise self.__graph_error(response.status, text, 'Failed to send draft', retry_after)
+        except BaseException:
+            try:
+                headers = {'Authorization': f'Bearer {await self.__get_access_token()}'}
+                async with self.__session.delete(message_url, headers=headers) as response:
+                    if response.status != 204:
+                        logger.warning(f'Failed to delete draft `{message_url}`: {await response.text()}')
+            except Exception as e:
+                logger.warning(f'Failed to delete draft `{message_url}`: {e!r}')
+            raise
+
+    @staticmethod
+    def __batch_mailbox(request: dict) -> str:
+        """`$batch`中单个请求(`/users/{mailbox}/sendMail`)使用的代理邮箱"""
+        return request['url'].split('/')[2]
+
+    def __batch_reply(self, mailbox: str, response: dict) -> str | Exception:
+        """将`$batch`中单个请求的响应转换为SMTP响应，并据此调整发信速率"""
+        status = response.get('status', 0)
+        headers = response.get('headers') or {}
+        retry_after = parse_retry_after(headers.get('Retry-After') or headers.get('retry-after'))
+        body = response.get('body')
+        text = json.dumps(body) if isinstance(body, dict) else str(body)
+        self.__report_status(mailbox, status, retry_after, text)
+        if status == 202:
+            return '250 Message accepted for delivery'
+        return self.__graph_error(status, text, 'Failed to send mail', retry_after)
+
+    async def __send_batch(self, requests: list[dict]) -> list[str | Exception]:
+        """通过一次`$batch`请求发送多封邮件，返回与请求顺序一致的结果"""
+        counts: dict[str, int] = {}
+        for i, request in enumerate(requests):
+            request['id'] = str(i)
+            mailbox = self.__batch_mailbox(request)
+            counts[mailbox] = counts.get(mailbox, 0) + 1
+        for mailbox, count in counts.items():
+            await self.__acquire_rate(mailbox, count)
+        headers = {'Authorization': f'Bearer {await self.__get_access_token()}'}
+        try:
+            with STAGE_SECONDS.time(stage='graph_send_batch'):
+                async with self.__session.post(f'{self.CONFIG.graph_base_url}/v1.0/$batch', headers=headers,
+                                               json={'requests': requests}) as response:
+                    if response.status != 200:
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        text = await response.text()
+                        for mailbox in counts:
+                            self.__report_status(mailbox, response.status, retry_after, text)
+                        raise self.__graph_error(response.status, text, 'Failed to send batch', retry_after)
+                    responses = {item.get('id'): item for item in (await response.json()).get('responses', [])}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise Exception(f'451 Failed to connect to Graph API: {e!r}')
+        results: list[str | Exception] = []
+        for request in requests:
+            if request['id'] not in responses:
+                results.append(Exception('451 No response for the request in batch'))
+                continue
+            # 逐个处理，单个请求的响应异常时不影响同一批中的其他请求
+            try:
+                results.append(self.__batch_reply(self.__batch_mailbox(request), responses[request['id']]))
+            except Exception as e:
+                logger.warning('Unexpected response for a batched request: %r', e)
+                results.append(Exception(f'451 Unexpected response for the request in batch: {e!r}'))
+        return results
+
+    def main_start(self):
+        # 多个工作进程时，通过共享的映射协调新用户的创建，避免多个进程重复创建同一个共享邮箱
+        if SMTP.workers > 1:
+            self.__multiprocessing_manager = mp.Manager()
+            self.__senders.share(self.__multiprocessing_manager.dict())
+
+    async def start(self):
+        SENDERS.set_function(lambda: len(self.__senders))
+        PENDING_SENDERS.set_function(lambda: self.__senders.pending_count)
+        SUSPENDED_MAILBOXES.set_function(lambda: self.__mailboxes.suspended_count)
+        self.__session = self.__create_session()
+        # 获取初始token，并启动提前续期的后台任务
+        await self.__get_access_token()
+        self.__access_token_renewal_task = asyncio.create_task(self.__task_renew_access_token())
+        # 初始化适配器，同步已有的用户列表，不重复创建用户
+        # 同时启动PowerShell工作进程，连接Exchange Online耗时较长
+        await asyncio.gather(self.__directory.start(), self.__powershell.start())
 
     async def send_mail(self, envelope: Envelope) -> str:
         # 解析发信用户名和地址，检查是否需要创建
-        mail = message_from_bytes(envelope.content)
-        from_header = mail.get("From")
-        from_name, from_addr = parseaddr(from_header)
-        from_name = str(make_header(decode_header(from_name)))
+        from_name, from_addr = MailContext.of(envelope).sender
         await self.__check_users(from_name, from_addr)
+        # 按发信地址选择代理邮箱，同一封邮件的所有请求都通过此邮箱发送
+        with self.__mailboxes.route(from_addr) as mailbox:
+            return await self.__send_mail(envelope, mailbox)
+
+    async def __send_mail(self, envelope: Envelope, mailbox: str) -> str:
+        # 超过大小限制的邮件通过草稿和上传会话发送
+        if len(envelope.content) > self.CONFIG.large_message_threshold_bytes:
+            try:
+                with STAGE_SECONDS.time(stage='graph_send_large'):
+                    return await self.__send_large_mail(envelope, mailbox)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise Exception(f'451 Failed to connect to Graph API: {e!r}')
+        # 较小的邮件合并为`$batch`请求发送。批处理中的请求体需要再进行一次base64编码
+        if self.CONFIG.batch_max_size > 1 and len(envelope.content) <= self.CONFIG.batch_max_message_bytes:
+            body = base64.b64encode(base64.b64encode(envelope.content)).decode('ascii')
+            return await self.__batcher.submit({
+                'method': 'POST',
+                'url': f'/users/{mailbox}/sendMail',
+                'headers': {'Content-Type': 'text/plain'},
+                'body': body
+            }, len(body))
         # 发送邮件
-        await self.__check_access_token()
-        url = f'https://graph.microsoft.com/v1.0/users/{self.CONFIG.sender}/sendMail'
+        await self.__acquire_rate(mailbox)
+        url = f'{self.CONFIG.graph_base_url}/v1.0/users/{mailbox}/sendMail'
+        # 请求体为base64编码的MIME内容，边编码边发送，不在内存中构造完整的编码结果
         headers = {
-            'Authorization': f'Bearer {self.__access_token}',
-            'Content-Type': 'text/plain'
+            'Authorization': f'Bearer {await self.__get_access_token()}',
+            'Content-Type': 'text/plain',
+            'Content-Length': str(base64_length(len(envelope.content)))
         }
-        mime_b64 = base64.b64encode(envelope.content).decode("ascii")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, data=mime_b64) as response:
-                if response.status == 202:
-                    return '250 Message accepted for delivery'
-                else:
-                    return f'550 {await response.text()}'
+        try:
+            with STAGE_SECONDS.time(stage='graph_send'):
+                async with self.__session.post(url, headers=headers,
+                                               data=base64_stream(envelope.content)) as response:
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    if response.status == 202:
+                        self.__report_status(mailbox, response.status)
+                        return '250 Message accepted for delivery'
+                    text = await response.text()
+                    self.__report_status(mailbox, response.status, retry_after, text)
+                    raise self.__graph_error(response.status, text, 'Failed to send mail', retry_after)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise Exception(f'451 Failed to connect to Graph API: {e!r}')
+
+    async def stop(self):
+        await self.__batcher.stop()
+        await self.__directory.stop()
+        await self.__provisioning.stop()
+        await self.__powershell.stop()
+        if self.__access_token_renewal_task is not None:
+            self.__access_token_renewal_task.cancel()
+            self.__access_token_renewal_task = None
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    def main_stop(self):
+        if self.__multiprocessing_manager is not None:
+            self.__multiprocessing_manager.shutdown()
+            self.__multiprocessing_manager = None
@@ -0,0 +1,23 @@
+import base64
+from typing import AsyncIterator
+
+# 3的整数倍，分块编码的结果可以直接拼接，中间不会出现填充字符
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+
+def base64_length(size: int) -> int:
+    """`size`字节的内容经过base64编码后的长度"""
+    return (size + 2) // 3 * 4
+
+
+async def base64_stream(content, chunk_size: int = BASE64_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    分块对内容进行base64编码，边编码边发送。
+
+    通过`memoryview`切片读取原始内容，不复制整封邮件，同一时刻只有一个编码后的分块在内存中。
+    `content`可以是`bytes`、`mmap`等任何支持缓冲区协议的对象。
+    """
+    chunk_size = max(chunk_size - chunk_size % 3, 3)
+    with memoryview(content) as view:
+        for offset in range(0, len(view), chunk_size):
+            yield base64.b64encode(view[offset:offset + chunk_size])
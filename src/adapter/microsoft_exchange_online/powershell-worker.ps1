@@ -0,0 +1,105 @@
+#!/usr/bin/pwsh
+# 常驻的Exchange Online管理进程。启动时连接一次Exchange Online，之后从标准输入逐行读取JSON请求，
+# 执行后向标准输出写入以`@@RESPONSE@@ `开头的一行JSON响应。其他输出会被调用方忽略。
+param(
+    [string]$Organization,
+    [string]$AppId,
+    [string]$CertificatePath,
+    [string]$CertificatePassword = $null
+)
+
+$ErrorActionPreference = 'Stop'
+
+function Connect-Exchange {
+    if ($CertificatePassword) {
+        $SecureCertificatePassword = ( $CertificatePassword | ConvertTo-SecureString -AsPlainText -Force )
+        Connect-ExchangeOnline -AppId $AppId -Organization $Organization -CertificateFilePath $CertificatePath -CertificatePassword $SecureCertificatePassword -ShowBanner:$false
+    } else {
+        Connect-ExchangeOnline -AppId $AppId -Organization $Organization -CertificateFilePath $CertificatePath -ShowBanner:$false
+    }
+}
+
+function Write-Response($Response) {
+    [Console]::Out.WriteLine('@@RESPONSE@@ ' + ($Response | ConvertTo-Json -Compress -Depth 5))
+    [Console]::Out.Flush()
+}
+
+try {
+    Connect-Exchange
+} catch {
+    Write-Response @{ id = 0; ok = $false; error = "$_" }
+    exit 1
+}
+Write-Response @{ id = 0; ok = $true; result = 'ready' }
+
+$running = $true
+while ($running) {
+    $line = [Console]::In.ReadLine()
+    if ($null -eq $line) {
+        break
+    }
+    if (-not $line.Trim()) {
+        continue
+    }
+    $request = $null
+    try {
+        $request = $line | ConvertFrom-Json
+        $result = $null
+        switch ($request.op) {
+            'ping' {
+                # 连接断开时重新连接
+                $connection = Get-ConnectionInformation | Where-Object { $_.State -eq 'Connected' }
+                if (-not $connection) {
+                    Connect-Exchange
+                }
+                $result = 'pong'
+            }
+            'create_mailboxes' {
+                # 批量创建共享邮箱，每个地址单独返回结果
+                $result = @()
+                foreach ($target in $request.targets) {
+                    try {
+                        New-Mailbox -Shared -Name $target.address -DisplayName $target.name -PrimarySmtpAddress $target.address | Out-Null
+                        # 为每个代理邮箱分配`SendAs`权限
+                        foreach ($sender in $request.senders) {
+                            Add-RecipientPermission -Identity $target.address -Trustee $sender -AccessRights SendAs -Confirm:$false | Out-Null
+                        }
+                        $result += @{ address = $target.address; ok = $true }
+                    } catch {
+                        $result += @{ address = $target.address; ok = $false; error = "$_" }
+                    }
+                }
+            }
+            'check_mailboxes' {
+                # 检查共享邮箱及其对所有代理邮箱的`SendAs`权限是否已经生效
+                $result = @()
+                foreach ($address in $request.addresses) {
+                    try {
+                        $ready = $true
+                        foreach ($sender in $request.senders) {
+                            if (-not (Get-RecipientPermission -Identity $address -Trustee $sender -AccessRights SendAs)) {
+                                $ready = $false
+                                break
+                            }
+                        }
+                        $result += @{ address = $address; ready = $ready }
+                    } catch {
+                        $result += @{ address = $address; ready = $false }
+                    }
+                }
+            }
+            'exit' {
+                $running = $false
+                $result = 'bye'
+            }
+            default {
+                throw "Unknown op: $($request.op)"
+            }
+        }
+        Write-Response @{ id = $request.id; ok = $true; result = @($result) }
+    } catch {
+        Write-Response @{ id = $request.id; ok = $false; error = "$_" }
+    }
+}
+
+Disconnect-ExchangeOnline -Confirm:$false
@@ -0,0 +1,171 @@
+import json
+import shlex
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_PREFIX = b'@@RESPONSE@@ '
+
+
+class PowerShellWorkerError(Exception):
+    """PowerShell工作进程本身出错(启动失败、超时、意外退出等)，需要重启工作进程"""
+
+
+class PowerShellCommandError(Exception):
+    """命令在PowerShell中执行失败，工作进程仍然可用"""
+
+
+class PowerShellWorker:
+    """
+    常驻的PowerShell工作进程。
+
+    进程启动时连接一次Exchange Online，之后通过标准输入输出逐条执行命令。
+    每条请求是一行JSON，响应是以`@@RESPONSE@@ `开头的一行JSON，其他输出会被记录到调试日志中。
+    """
+
+    def __init__(self, index: int, cmd: list[str], startup_timeout: float, command_timeout: float):
+        self.index = index
+        self.__cmd = cmd
+        self.__startup_timeout = startup_timeout
+        self.__command_timeout = command_timeout
+        self.__process: asyncio.subprocess.Process | None = None
+        self.__stderr_task: asyncio.Task | None = None
+        self.__request_id = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.__process is not None and self.__process.returncode is None
+
+    async def __drain_stderr(self):
+        while line := await self.__process.stderr.readline():
+            logger.debug('[pwsh-%d] STDERR: %s', self.index, line.decode(errors='replace').rstrip())
+
+    async def __read_response(self, request_id: int) -> dict:
+        while True:
+            line = await self.__process.stdout.readline()
+            if not line:
+                raise PowerShellWorkerError(f'PowerShell worker {self.index} exited unexpectedly '
+                                            f'with code {await self.__process.wait()}')
+            if not line.startswith(RESPONSE_PREFIX):
+                logger.debug('[pwsh-%d] OUTPUT: %s', self.index, line.decode(errors='replace').rstrip())
+                continue
+            response = json.loads(line[len(RESPONSE_PREFIX):])
+            if response.get('id') == request_id:
+                return response
+
+    async def start(self):
+        logger.debug(f'[pwsh-{self.index}] Running command: `{" ".join(shlex.quote(x) for x in self.__cmd)}`')
+        self.__request_id = 0
+        try:
+            self.__process = await asyncio.create_subprocess_exec(
+                *self.__cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            # 例如找不到`powershell_cmd`或没有执行权限，视为工作进程不可用(临时错误)，而不是拒绝邮件
+            self.__process = None
+            raise PowerShellWorkerError(f'PowerShell worker {self.index} failed to launch: {e!r}')
+        self.__stderr_task = asyncio.create_task(self.__drain_stderr())
+        try:
+            response = await asyncio.wait_for(self.__read_response(0), self.__startup_timeout)
+        except (asyncio.TimeoutError, PowerShellWorkerError, ValueError) as e:
+            await self.kill()
+            raise PowerShellWorkerError(f'PowerShell worker {self.index} failed to start: {e!r}')
+        if not response['ok']:
+            await self.kill()
+            raise PowerShellWorkerError(f'PowerShell worker {self.index} failed to connect: {response["error"]}')
+        logger.info(f'PowerShell worker {self.index} connected to Exchange Online.')
+
+    async def call(self, op: str, **kwargs):
+        """执行一条命令并返回结果。同一工作进程同时只能执行一条命令"""
+        if not self.alive:
+            raise PowerShellWorkerError(f'PowerShell worker {self.index} is not running')
+        self.__request_id += 1
+        request_id = self.__request_id
+        try:
+            self.__process.stdin.write(json.dumps({'id': request_id, 'op': op, **kwargs}).encode() + b'\n')
+            await self.__process.stdin.drain()
+            response = await asyncio.wait_for(self.__read_response(request_id), self.__command_timeout)
+        except (asyncio.TimeoutError, OSError, ValueError) as e:
+            await self.kill()
+            raise PowerShellWorkerError(f'PowerShell worker {self.index} failed while running `{op}`: {e!r}')
+        except PowerShellWorkerError:
+            await self.kill()
+            raise
+        if not response['ok']:
+            raise PowerShellCommandError(response['error'])
+        return response.get('result')
+
+    async def kill(self):
+        if self.alive:
+            self.__process.kill()
+        if self.__process is not None:
+            await self.__process.wait()
+        if self.__stderr_task is not None:
+            self.__stderr_task.cancel()
+            self.__stderr_task = None
+
+    async def stop(self):
+        if self.alive:
+            try:
+                await asyncio.wait_for(self.call('exit'), 30)
+                await asyncio.wait_for(self.__process.wait(), 30)
+            except Exception as e:
+                logger.warning(f'PowerShell worker {self.index} did not exit cleanly: {e!r}')
+        await self.kill()
+
+
+class PowerShellWorkerPool:
+    """PowerShell工作进程池，失效的工作进程会在下次使用或健康检查时重启"""
+
+    def __init__(self, size: int, cmd: list[str], startup_timeout: float = 180, command_timeout: float = 300,
+                 health_check_interval: float = 300):
+        self.__workers = [PowerShellWorker(i, cmd, startup_timeout, command_timeout) for i in range(max(size, 1))]
+        self.__health_check_interval = health_check_interval
+        self.__idle: asyncio.Queue[PowerShellWorker] | None = None
+        self.__health_check_task: asyncio.Task | None = None
+
+    async def __ensure_started(self, worker: PowerShellWorker):
+        if not worker.alive:
+            await worker.start()
+
+    async def start(self):
+        self.__idle = asyncio.Queue()
+        results = await asyncio.gather(*[worker.start() for worker in self.__workers], return_exceptions=True)
+        for worker, result in zip(self.__workers, results):
+            if isinstance(result, Exception):
+                logger.error(f'{result} It will be restarted on demand.')
+            self.__idle.put_nowait(worker)
+        if self.__health_check_interval > 0:
+            self.__health_check_task = asyncio.create_task(self.__task_health_check())
+
+    async def call(self, op: str, **kwargs):
+        worker = await self.__idle.get()
+        try:
+            await self.__ensure_started(worker)
+            return await worker.call(op, **kwargs)
+        finally:
+            self.__idle.put_nowait(worker)
+
+    async def __task_health_check(self):
+        """定期检查空闲的工作进程，重启已经退出或无响应的进程"""
+        while True:
+            await asyncio.sleep(self.__health_check_interval)
+            for _ in range(len(self.__workers)):
+                worker = await self.__idle.get()
+                try:
+                    await self.__ensure_started(worker)
+                    await worker.call('ping')
+                except Exception as e:
+                    logger.warning(f'PowerShell worker {worker.index} health check failed: {e}')
+                finally:
+                    self.__idle.put_nowait(worker)
+
+    async def stop(self):
+        if self.__health_check_task is not None:
+            self.__health_check_task.cancel()
+            self.__health_check_task = None
+        await asyncio.gather(*[worker.stop() for worker in self.__workers], return_exceptions=True)
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import statistics
+from collections import deque
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class ProvisioningBatcher:
+    """
+    共享邮箱批量创建器。
+
+    在短时间窗口内收集待创建的地址，攒够一批后交给`create_batch`一次性创建，
+    每个调用者仍然只等待自己地址的创建结果。
+    `create_batch`接收`(地址, 名称)`列表，返回地址到异常的映射，创建成功的地址对应`None`。
+    """
+
+    def __init__(self, create_batch: Callable[[list[tuple[str, str]]], Awaitable[dict[str, Exception | None]]],
+                 window_seconds: float = 1, max_size: int = 20):
+        self.__create_batch = create_batch
+        self.__window_seconds = window_seconds
+        self.__max_size = max(max_size, 1)
+        self.__pending: list[tuple[str, str, asyncio.Future]] = []
+        self.__timer: asyncio.TimerHandle | None = None
+        self.__tasks: set[asyncio.Task] = set()
+
+    async def submit(self, address: str, name: str):
+        future = asyncio.get_running_loop().create_future()
+        self.__pending.append((address, name, future))
+        if len(self.__pending) >= self.__max_size:
+            self.__flush()
+        elif self.__timer is None:
+            self.__timer = asyncio.get_running_loop().call_later(self.__window_seconds, self.__flush)
+        await future
+
+    def __flush(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        batch, self.__pending = self.__pending, []
+        if batch:
+            task = asyncio.create_task(self.__run(batch))
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    async def __run(self, batch: list[tuple[str, str, asyncio.Future]]):
+        logger.info(f'Creating {len(batch)} user(s) in one batch...')
+        try:
+            results = await self.__create_batch([(address, name) for address, name, _ in batch])
+        except Exception as e:
+            results = {address: e for address, _, _ in batch}
+        for address, _, future in batch:
+            if future.done():
+                continue
+            if (error := results.get(address, Exception(f'451 No result for `{address}`'))) is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def stop(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        for task in self.__tasks:
+            task.cancel()
+
+
+class PropagationEstimator:
+    """
+    新用户传播耗时估计器。
+
+    记录最近若干次新用户从创建完成到`SendAs`权限生效的耗时，
+    首次检查前的等待时间取观测中位数的一半，之后按指数退避轮询，使等待时间跟随实际的传播耗时。
+    """
+
+    def __init__(self, initial_seconds: float, history_size: int = 100):
+        self.__initial_seconds = initial_seconds
+        self.__history: deque[float] = deque(maxlen=history_size)
+
+    def record(self, seconds: float):
+        self.__history.append(seconds)
+
+    @property
+    def initial_delay(self) -> float:
+        return statistics.median(self.__history or [self.__initial_seconds]) / 2
@@ -0,0 +1,93 @@
+import time
+import asyncio
+import logging
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """解析`Retry-After`头，支持秒数和HTTP日期两种格式"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    速率自适应的令牌桶(AIMD)。
+
+    请求按当前速率获取令牌，令牌不足时排队等待，等待的请求按先来后到的顺序放行，一批请求可以一次获取多个令牌。
+    被限流时速率按`decrease_factor`成倍降低，并在`Retry-After`指定的时间内暂停放行；
+    令牌确实成为瓶颈时，每次成功的请求使速率增加`increase_per_second / rate`，即满负荷时每秒增加约`increase_per_second`。
+    这样速率会稳定在服务端限额附近，而不是在突发和集中限流之间来回震荡。
+    """
+
+    def __init__(self, name: str, rate: float, max_rate: float, increase_per_second: float = 1,
+                 decrease_factor: float = 0.5, burst_seconds: float = 1):
+        self.name = name
+        self.rate = rate
+        self.__min_rate = min(rate, 0.1)
+        self.__max_rate = max(max_rate, rate)
+        self.__increase_per_second = increase_per_second
+        self.__decrease_factor = decrease_factor
+        self.__burst_seconds = burst_seconds
+        self.__tokens = self.__capacity
+        self.__updated_at = time.monotonic()
+        self.__blocked_until = 0.0
+        self.__decrease_hold_until = 0.0
+        self.__limited = False  # 最近一次获取令牌时是否因为令牌不足而等待
+        self.__lock = asyncio.Lock()
+
+    @property
+    def __capacity(self) -> float:
+        return max(self.rate * self.__burst_seconds, 1)
+
+    def __refill(self, now: float):
+        self.__tokens = min(self.__tokens + (now - self.__updated_at) * self.rate, self.__capacity)
+        self.__updated_at = now
+
+    async def acquire(self, tokens: float = 1):
+        # 等待的请求依次排队，先到先得
+        async with self.__lock:
+            waited = False
+            while True:
+                now = time.monotonic()
+                if (delay := self.__blocked_until - now) > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                self.__refill(now)
+                # 一次获取的令牌数超过桶容量时，允许透支
+                needed = min(tokens, self.__capacity)
+                if self.__tokens >= needed:
+                    self.__tokens -= tokens
+                    self.__limited = waited
+                    return
+                waited = True
+                await asyncio.sleep((needed - self.__tokens) / self.rate)
+
+    def on_success(self):
+        # 只有令牌确实成为瓶颈时才提高速率，避免空闲时速率无限增长
+        if (self.__limited or self.__lock.locked()) and self.rate < self.__max_rate:
+            self.rate = min(self.rate + self.__increase_per_second / self.rate, self.__max_rate)
+
+    def on_throttled(self, retry_after: float | None = None):
+        now = time.monotonic()
+        self.__refill(now)
+        self.__tokens = min(self.__tokens, 0)
+        if retry_after:
+            self.__blocked_until = max(self.__blocked_until, now + retry_after)
+        # 同一轮限流中并发的多个请求只降低一次速率
+        if now < self.__decrease_hold_until:
+            return
+        self.__decrease_hold_until = now + max(retry_after or 0, 1)
+        self.rate = max(self.rate * self.__decrease_factor, self.__min_rate)
+        logger.warning(f'Throttled by Graph API on `{self.name}`, rate lowered to {self.rate:.2f}/s'
+                       + (f', pausing for {retry_after:.0f}s.' if retry_after else '.'))
@@ -0,0 +1,113 @@
+import os
+import time
+import asyncio
+from typing import Awaitable, Callable, Iterable, MutableMapping
+
+SHARED_KNOWN = 'known'
+
+
+class SenderRegistry:
+    """
+    发信地址注册表。
+
+    记录已经存在共享邮箱的发信地址(不区分大小写)，以及正在创建中的地址。
+    同一地址同时只会被创建一次，其他任务直接等待创建结果；创建失败时，异常会传递给所有等待者。
+
+    多个工作进程时可以通过`share()`设置一个跨进程共享的映射(如`multiprocessing.Manager().dict()`)，
+    本地集合仍作为缓存，只有本地未知的地址才会查询共享映射。创建前先在共享映射中原子地占用地址，
+    其他进程发现地址正在创建时会等待其结果，而不是重复创建。
+    """
+
+    def __init__(self, claim_poll_seconds: float = 1, claim_stale_seconds: float = 900):
+        self.__known: set[str] = set()
+        self.__pending: dict[str, asyncio.Future] = {}
+        self.__shared: MutableMapping[str, str] | None = None
+        self.__claim_poll_seconds = claim_poll_seconds
+        self.__claim_stale_seconds = claim_stale_seconds
+
+    @staticmethod
+    def normalize(addr: str) -> str:
+        return addr.strip().lower()
+
+    def __contains__(self, addr: str) -> bool:
+        return self.normalize(addr) in self.__known
+
+    def __len__(self) -> int:
+        return len(self.__known)
+
+    @property
+    def pending_count(self) -> int:
+        return len(self.__pending)
+
+    def add(self, addr: str):
+        self.__known.add(self.normalize(addr))
+
+    def update(self, addrs: Iterable[str]):
+        self.__known.update(self.normalize(addr) for addr in addrs)
+
+    def discard(self, addr: str):
+        self.__known.discard(self.normalize(addr))
+
+    def share(self, shared: MutableMapping[str, str]):
+        """设置跨进程共享的地址状态映射，需要在工作进程启动前调用"""
+        self.__shared = shared
+
+    async def __claim(self, key: str) -> bool:
+        """
+        在共享映射中占用地址。成功占用时返回`True`，由调用者负责创建；
+        地址已经被其他进程创建完成时返回`False`。
+        """
+        token = f'creating:{os.getpid()}:{time.time()}'
+        while True:
+            # 代理对象的每次调用都是一次阻塞的进程间通信，放到线程中执行
+            state = await asyncio.to_thread(self.__shared.setdefault, key, token)
+            if state == token:
+                return True
+            if state == SHARED_KNOWN:
+                return False
+            if time.time() - float(state.rsplit(':', 1)[1]) > self.__claim_stale_seconds:
+                # 占用地址的进程可能已经退出，接管创建
+                await asyncio.to_thread(self.__shared.__setitem__, key, token)
+                return True
+            await asyncio.sleep(self.__claim_poll_seconds)
+
+    async def __create(self, key: str, create: Callable[[], Awaitable[None]]):
+        if self.__shared is None:
+            await create()
+            return
+        if not await self.__claim(key):
+            return
+        try:
+            await create()
+        except BaseException:
+            await asyncio.to_thread(self.__shared.pop, key, None)
+            raise
+        await asyncio.to_thread(self.__shared.__setitem__, key, SHARED_KNOWN)
+
+    async def ensure(self, addr: str, create: Callable[[], Awaitable[None]]):
+        """确保地址已存在。地址未知时调用`create`创建，正在被其他任务创建时等待其完成"""
+        key = self.normalize(addr)
+        if key in self.__known:
+            return
+        if (future := self.__pending.get(key)) is not None:
+            await asyncio.shield(future)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[key] = future
+        try:
+            await self.__create(key, create)
+        except asyncio.CancelledError:
+            future.set_exception(Exception(f'451 Creation of `{addr}` was interrupted'))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 标记异常已被取走，没有等待者时不会产生警告
+            future.exception()
+            raise
+        else:
+            self.__known.add(key)
+            future.set_result(None)
+        finally:
+            del self.__pending[key]
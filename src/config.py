@@ -7,64 +7,84 @@ class LogConfig(BaseModel):
   level: str = 'INFO'
   dump_enabled: bool = True
   dump_retain_days: int = 7
+  queue_size: int = 10000
+  queue_full_policy: str = 'drop'
 
 class SmtpServerConfig(BaseModel):
   listen_host: str = 'auto'
   listen_port: int = 25
+  workers: int = 1
   stop_email_loop: bool = True
   email_loop_threshold: int = 3
   email_loop_check_time_minutes: int = 3
   email_loop_ban_time_minutes: int = 30
+  email_loop_max_entries: int = 100000
+  email_loop_hash: str = 'sha256'
+  email_loop_backend: str = 'memory'
+  email_loop_redis_url: str = 'redis://127.0.0.1:6379/0'
+  email_loop_redis_timeout_seconds: float = 0.5
+  email_loop_redis_key_prefix: str = 'smtp-external-relayer:loop:'
   email_loop_alert_from_email:str = ''
   email_loop_alert_to_email:str = ''
+  data_size_limit: int = 33554432
+  data_spill_threshold_bytes: int = 1048576
+  data_spill_dir: str = ''
 
 class AdapterConfig(BaseModel):
     use: str = 'aliyun-directmail'
 
+class SpoolConfig(BaseModel):
+    enabled: bool = False
+    path: str = '../spool'
+    workers: int = 4
+    max_attempts: int = 10
+    retry_base_seconds: float = 30
+    retry_max_seconds: float = 3600
+
+class MetricsConfig(BaseModel):
+    enabled: bool = False
+    listen_host: str = '127.0.0.1'
+    listen_port: int = 9101
+
 
 initialized = False
+# 配置文件路径，可以通过`APP_CONFIG_PATH`环境变量指定
+CONFIG_PATH = os.environ.get('APP_CONFIG_PATH', '../config/config.yaml')
 LOG: LogConfig | None = None
 SMTP: SmtpServerConfig | None = None
 ADAPTER: AdapterConfig | None = None
+SPOOL: SpoolConfig | None = None
+METRICS: MetricsConfig | None = None
+
+
+def __override_from_env(config: BaseModel, prefix: str):
+    """使用`APP_<PREFIX>_<FIELD>`环境变量覆盖配置项"""
+    for field, info in config.model_fields.items():
+        if val_raw := os.environ.get(f'APP_{prefix}_{field.upper()}'):
+            val_type = info.annotation
+            if val_type not in (str, int, float):
+                continue
+            try:
+                setattr(config, field, val_type(val_raw))
+            except Exception as e:
+                raise ValueError(f'Failed to parse config `{prefix}.{field}` '
+                                 f'from env `APP_{prefix}_{field.upper()}`: {e}')
 
 def initialize():
-    global LOG, SMTP, ADAPTER
-    with open('../config/config.yaml', 'r', encoding='utf-8') as f:
+    global LOG, SMTP, ADAPTER, SPOOL, METRICS
+    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
         __data = yaml.safe_load(f)
     LOG = LogConfig(**__data['log'])
     SMTP = SmtpServerConfig(**__data['smtp_server'])
     ADAPTER = AdapterConfig(**__data['adapter'])
+    SPOOL = SpoolConfig(**__data.get('spool', {}))
+    METRICS = MetricsConfig(**__data.get('metrics', {}))
     # 环境变量覆盖
-    for field, info in LOG.model_fields.items():
-        if val_raw := os.environ.get(f'APP_LOG_{field.upper()}'):
-            val_type = info.annotation
-            if val_type not in (str, int, float):
-                continue
-            try:
-                setattr(LOG, field, val_type(val_raw))
-            except Exception as e:
-                raise ValueError(f'Failed to parse config `LOG.{field}` '
-                                 f'from env `APP_LOG_{field.upper()}`: {e}')
-    for field, info in SMTP.model_fields.items():
-        if val_raw := os.environ.get(f'APP_SMTP_{field.upper()}'):
-            val_type = info.annotation
-            if val_type not in (str, int, float):
-                continue
-            try:
-                setattr(SMTP, field, val_type(val_raw))
-            except Exception as e:
-                raise ValueError(f'Failed to parse config `SMTP.{field}` '
-                                 f'from env `APP_SMTP_{field.upper()}`: {e}')
-    for field, info in ADAPTER.model_fields.items():
-        if val_raw := os.environ.get(f'APP_ADAPTER_{field.upper()}'):
-            val_type = info.annotation
-            if val_type not in (str, int, float):
-                continue
-            try:
-                setattr(ADAPTER, field, val_type(val_raw))
-            except Exception as e:
-                raise ValueError(f'Failed to parse config `ADAPTER.{field}` '
-                                 f'from env `APP_ADAPTER_{field.upper()}`: {e}')
+    __override_from_env(LOG, 'LOG')
+    __override_from_env(SMTP, 'SMTP')
+    __override_from_env(ADAPTER, 'ADAPTER')
+    __override_from_env(SPOOL, 'SPOOL')
+    __override_from_env(METRICS, 'METRICS')
 
 if not initialized:
     initialize()
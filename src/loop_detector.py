@@ -0,0 +1,233 @@
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Callable, NamedTuple
+from collections import OrderedDict
+from util import RespClient, RespError
+
+logger = logging.getLogger(__name__)
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def get_digest_factory(name: str) -> Callable:
+    """
+    获取计算邮件摘要的哈希对象构造函数。
+
+    `sha256`为默认算法；`blake2b`使用16字节摘要，速度更快；`xxhash`为非加密哈希，速度最快，需要安装`xxhash`包。
+    """
+    if name == 'sha256':
+        return hashlib.sha256
+    if name == 'blake2b':
+        return lambda: hashlib.blake2b(digest_size=16)
+    if name == 'xxhash':
+        if xxhash is not None:
+            return xxhash.xxh3_128
+        logger.warning('Package `xxhash` is not installed. Using `blake2b` for email loop check instead.')
+        return lambda: hashlib.blake2b(digest_size=16)
+    raise ValueError(f'Unknown email loop hash `{name}`. Expected `sha256`, `blake2b` or `xxhash`.')
+
+
+class LoopCheckResult(NamedTuple):
+    count: int  # 检测时间窗口内的发送次数(包括本次)
+    banned: bool  # 此邮件已经处于封禁中
+    triggered: bool  # 本次检查触发了封禁
+    ban_remaining_seconds: float  # 封禁剩余的秒数
+
+
+class _Entry:
+    __slots__ = ('counts', 'last_bucket', 'last_seen', 'ban_until')
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * buckets
+        self.last_bucket = 0
+        self.last_seen = 0.0
+        self.ban_until = 0.0
+
+
+class EmailLoopDetector:
+    """
+    内存占用有上限的邮件循环检测器。
+
+    以邮件摘要的原始字节为键，把检测时间窗口划分为若干个时间桶，每个键只保存各时间桶内的发送次数。
+    条目按最近访问的顺序排列，数量超过上限时淘汰最久未访问的条目；每次检查时顺带清理少量已过期的条目，
+    因此不需要定期全量扫描，单次检查的开销为O(1)。时间使用单调时钟。
+    """
+
+    def __init__(self, threshold: int, window_seconds: float, ban_seconds: float,
+                 max_entries: int = 100000, buckets: int = 6):
+        if window_seconds <= 0:
+            raise ValueError(f'Email loop check window must be positive, got {window_seconds}s.')
+        self.__threshold = threshold
+        self.__window_seconds = window_seconds
+        self.__ban_seconds = ban_seconds
+        self.__max_entries = max(max_entries, 1)
+        self.__buckets = max(buckets, 1)
+        self.__bucket_seconds = window_seconds / self.__buckets
+        self.__entries: OrderedDict[bytes, _Entry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __expired(self, entry: _Entry, now: float) -> bool:
+        return now > entry.ban_until and now - entry.last_seen >= self.__window_seconds
+
+    def __expire_oldest(self, now: float, limit: int = 2):
+        """清理最久未访问的若干个过期条目"""
+        for _ in range(limit):
+            if not self.__entries:
+                return
+            key, entry = next(iter(self.__entries.items()))
+            if not self.__expired(entry, now):
+                return
+            del self.__entries[key]
+
+    def check(self, key: bytes, now: float | None = None) -> LoopCheckResult:
+        now = time.monotonic() if now is None else now
+        self.__expire_oldest(now)
+
+        entry = self.__entries.get(key)
+        if entry is not None:
+            if now <= entry.ban_until:
+                self.__entries.move_to_end(key)
+                return LoopCheckResult(sum(entry.counts), True, False, entry.ban_until - now)
+            if entry.ban_until or self.__expired(entry, now):
+                # 封禁已经结束或记录已经过期，重新开始统计
+                del self.__entries[key]
+                entry = None
+        if entry is None:
+            entry = _Entry(self.__buckets)
+            self.__entries[key] = entry
+            if len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+        else:
+            self.__entries.move_to_end(key)
+
+        # 清零上次访问之后已经滑出窗口的时间桶
+        bucket = int(now // self.__bucket_seconds)
+        if bucket - entry.last_bucket >= self.__buckets:
+            entry.counts = [0] * self.__buckets
+        else:
+            for i in range(entry.last_bucket + 1, bucket + 1):
+                entry.counts[i % self.__buckets] = 0
+        entry.counts[bucket % self.__buckets] += 1
+        entry.last_bucket = bucket
+        entry.last_seen = now
+
+        count = sum(entry.counts)
+        if count >= self.__threshold:
+            entry.ban_until = now + self.__ban_seconds
+            return LoopCheckResult(count, False, True, self.__ban_seconds)
+        return LoopCheckResult(count, False, False, 0.0)
+
+
+class LoopStateBackend:
+    """邮件循环检测状态的存储后端。基类不保存任何状态，从不封禁邮件，用于关闭邮件循环检测"""
+
+    async def start(self):
+        pass
+
+    async def check(self, key: bytes) -> LoopCheckResult:
+        return LoopCheckResult(1, False, False, 0.0)
+
+    def __len__(self) -> int:
+        return 0
+
+    async def stop(self):
+        pass
+
+
+class MemoryLoopStateBackend(LoopStateBackend):
+    """进程内的状态后端，只能检测到经过本进程的邮件循环"""
+
+    def __init__(self, detector: EmailLoopDetector):
+        self.detector = detector
+
+    async def check(self, key: bytes) -> LoopCheckResult:
+        return self.detector.check(key)
+
+    def __len__(self) -> int:
+        return len(self.detector)
+
+
+class RedisLoopStateBackend(LoopStateBackend):
+    """
+    基于Redis协议存储的状态后端，多个中继副本共享检测计数和封禁状态。
+
+    每个时间桶的计数是一个带过期时间的键，每次检查只需要一次流水线请求(PTTL + INCR + PEXPIRE + MGET)，
+    仅在触发封禁时再写入一次封禁键。存储不可用时退回到进程内检测，并在一段时间后重新尝试连接。
+    """
+
+    def __init__(self, client: RespClient, threshold: int, window_seconds: float, ban_seconds: float,
+                 fallback: EmailLoopDetector, key_prefix: str = 'smtp-external-relayer:loop:',
+                 buckets: int = 6, retry_seconds: float = 30):
+        self.__client = client
+        self.__threshold = threshold
+        self.__window_ms = int(window_seconds * 1000)
+        self.__ban_ms = int(ban_seconds * 1000)
+        self.__buckets = max(buckets, 1)
+        self.__bucket_ms = max(self.__window_ms // self.__buckets, 1)
+        self.__key_prefix = key_prefix
+        self.__retry_seconds = retry_seconds
+        self.__unavailable_until = 0.0
+        self.fallback = fallback
+
+    async def start(self):
+        try:
+            await self.__client.connect()
+            logger.info(f'Email loop state is shared via {self.__client.host}:{self.__client.port}.')
+        except (OSError, asyncio.TimeoutError, RespError) as e:
+            self.__mark_unavailable(e)
+
+    def __mark_unavailable(self, error: Exception):
+        if time.monotonic() >= self.__unavailable_until:
+            logger.warning(f'Email loop state store is unavailable, using local state for '
+                           f'{self.__retry_seconds:.0f}s: {error!r}')
+        self.__unavailable_until = time.monotonic() + self.__retry_seconds
+
+    async def __check_remote(self, key: bytes) -> LoopCheckResult:
+        if not self.__client.connected:
+            await self.__client.connect()
+        key_hex = key.hex()
+        ban_key = f'{self.__key_prefix}ban:{key_hex}'
+        bucket = int(time.time() * 1000) // self.__bucket_ms
+        count_keys = [f'{self.__key_prefix}count:{key_hex}:{bucket - i}' for i in range(self.__buckets)]
+        replies = await self.__client.pipeline(
+            ('PTTL', ban_key),
+            ('INCR', count_keys[0]),
+            ('PEXPIRE', count_keys[0], self.__window_ms + self.__bucket_ms),
+            ('MGET', *count_keys[1:]) if len(count_keys) > 1 else ('PING',)
+        )
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        ban_ttl, current, _, previous = replies
+        if ban_ttl > 0:
+            return LoopCheckResult(current, True, False, ban_ttl / 1000)
+        count = current
+        if isinstance(previous, list):
+            count += sum(int(x) for x in previous if x is not None)
+        if count < self.__threshold:
+            return LoopCheckResult(count, False, False, 0.0)
+        # 多个副本同时触发时只有一个能写入封禁键，由它负责发送告警
+        if await self.__client.execute('SET', ban_key, 1, 'PX', self.__ban_ms, 'NX') is None:
+            return LoopCheckResult(count, True, False, self.__ban_ms / 1000)
+        return LoopCheckResult(count, False, True, self.__ban_ms / 1000)
+
+    async def check(self, key: bytes) -> LoopCheckResult:
+        if time.monotonic() >= self.__unavailable_until:
+            try:
+                return await self.__check_remote(key)
+            except (OSError, asyncio.TimeoutError, RespError) as e:
+                self.__mark_unavailable(e)
+        return self.fallback.check(key)
+
+    def __len__(self) -> int:
+        return len(self.fallback)
+
+    async def stop(self):
+        await self.__client.close()
@@ -1,12 +1,26 @@
 #!/bin/python3
 import sys
+import queue
+import signal
 import asyncio
 import logging
-from logging.handlers import TimedRotatingFileHandler
-from config import LOG, ADAPTER
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from logging.handlers import TimedRotatingFileHandler, QueueListener
+from config import LOG, SMTP, ADAPTER
+from metrics import gauge
+from util import BoundedQueueHandler
 import smtp_server
 
-def initialize_logging():
+LOG_RECORDS_DROPPED = gauge('smtp_relayer_log_records_dropped', 'Log records dropped because the log queue was full.')
+
+def initialize_logging() -> QueueListener:
+    """
+    初始化日志，返回写入日志的后台监听器。
+
+    日志记录先放入有界队列，由主进程中的后台线程写入标准输出和日志文件，磁盘写入和日志轮转不会阻塞事件循环。
+    多个工作进程时使用跨进程的队列，所有进程的日志都由主进程写入同一个文件。
+    """
     logging_handlers = [logging.StreamHandler(sys.stdout)]
     if LOG.dump_enabled:
         logging_handlers.append(
@@ -19,18 +33,101 @@ def initialize_logging():
                 utc=False
             )
         )
-    logging.basicConfig(
-        level=LOG.level,
-        format='[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
-        handlers=logging_handlers
+    formatter = logging.Formatter(
+        '[%(asctime)s] [%(processName)s] [%(name)s] [%(levelname)s] %(message)s' if SMTP.workers > 1
+        else '[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s'
     )
+    for handler in logging_handlers:
+        handler.setFormatter(formatter)
+    if SMTP.workers > 1:
+        # 工作进程由fork启动，继承同一个跨进程队列
+        log_queue = mp.get_context('fork').Queue(LOG.queue_size)
+    else:
+        log_queue = queue.Queue(LOG.queue_size)
+    queue_handler = BoundedQueueHandler(log_queue, LOG.queue_full_policy)
+    # 入队前只合并消息和参数，完整的格式化由监听器中的处理器完成
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=LOG.level, handlers=[queue_handler])
+    LOG_RECORDS_DROPPED.set_function(lambda: queue_handler.dropped)
+    listener = QueueListener(log_queue, *logging_handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def run_worker(index: int):
+    """工作进程入口，运行一个完整的SMTP服务器和适配器实例"""
+    # 中断由主进程统一转换为SIGTERM，避免终端的Ctrl+C同时打断所有工作进程
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        asyncio.run(smtp_server.start(index))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(count: int) -> bool:
+    """
+    启动多个工作进程并等待它们退出。
+
+    各工作进程通过`SO_REUSEPORT`监听同一端口。主进程收到`SIGINT`/`SIGTERM`，
+    或任一工作进程意外退出时，向所有工作进程发送`SIGTERM`，等待它们各自完成清理后再返回。
+    返回是否有工作进程意外退出。
+    """
+    logger = logging.getLogger('main')
+    # 使用fork启动，工作进程直接继承主进程中已加载的配置和适配器
+    context = mp.get_context('fork')
+    processes = [
+        context.Process(target=run_worker, args=(i,), name=f'smtp-worker-{i}')
+        for i in range(count)
+    ]
+    stopping = False
+    failed = False
+
+    def stop_all(*_):
+        nonlocal stopping
+        stopping = True
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop_all)
+    signal.signal(signal.SIGINT, stop_all)
+    for process in processes:
+        process.start()
+    logger.info(f'Started {count} SMTP worker processes.')
+
+    running = list(processes)
+    while running:
+        for sentinel in wait([process.sentinel for process in running]):
+            process = next(p for p in running if p.sentinel == sentinel)
+            process.join()
+            running.remove(process)
+            if not stopping:
+                failed = True
+                logger.error(f'Worker `{process.name}` exited unexpectedly with code {process.exitcode}. '
+                             f'Stopping all workers...')
+                stop_all()
+    return failed
+
 
 if __name__ == '__main__':
-    initialize_logging()
+    log_listener = initialize_logging()
     logger = logging.getLogger('main')
     logger.info('Config loaded.')
     logger.info(f'Using adapter: {ADAPTER.use}')
     logger.info('Starting SMTP External Relayer...')
     smtp_server.adapter.main_start()
-    asyncio.run(smtp_server.start())
+    failed = False
+    try:
+        if SMTP.workers > 1:
+            failed = run_workers(SMTP.workers)
+        else:
+            try:
+                asyncio.run(smtp_server.start())
+            except KeyboardInterrupt:
+                pass
+    finally:
+        smtp_server.adapter.main_stop()
     logger.info('SMTP External Relayer stopped.')
+    log_listener.stop()
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,250 @@
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def __escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{__escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.__values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.__values[key] = self.__values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        return [f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+                for key, value in list(self.__values.items())]
+
+
+class Gauge(_Metric):
+    """
+    可增可减的瞬时值。
+
+    可以通过`set_function()`设置取值函数，抓取时才计算数值，适合表示队列长度、缓存大小等已有的状态。
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.__values: dict[tuple, float] = {}
+        self.__functions: dict[tuple, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self.__values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.__values[key] = self.__values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels):
+        self.__functions[self._key(labels)] = function
+
+    def _samples(self) -> list[str]:
+        values = dict(self.__values)
+        for key, function in list(self.__functions.items()):
+            try:
+                values[key] = function()
+            except Exception as e:
+                logger.debug(f'Failed to collect gauge `{self.name}`: {e!r}')
+        return [f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+                for key, value in values.items()]
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: 'Histogram', labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(_Metric):
+    """按桶统计观测值分布的直方图，每个观测值只需要一次二分查找"""
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.__buckets = tuple(sorted(buckets))
+        # 每组标签对应各个桶内(非累计)的数量，最后一个为+Inf桶，以及观测值总和
+        self.__counts: dict[tuple, list[int]] = {}
+        self.__sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.__counts.get(key)
+        if counts is None:
+            counts = self.__counts[key] = [0] * (len(self.__buckets) + 1)
+            self.__sums[key] = 0.0
+        counts[bisect_left(self.__buckets, value)] += 1
+        self.__sums[key] += value
+
+    def time(self, **labels) -> _Timer:
+        """返回一个计时的上下文管理器，退出时记录经过的秒数"""
+        return _Timer(self, labels)
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, counts in list(self.__counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.__buckets + (float('inf'),), counts):
+                cumulative += count
+                le = _format_labels(self.label_names, key, f'le="{_format_value(float(bound))}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = _format_labels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(self.__sums[key])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.__metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self.__metrics:
+            raise ValueError(f'Metric `{metric.name}` is already registered.')
+        self.__metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.__metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def gauge(name: str, documentation: str, labels: tuple[str, ...] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labels))
+
+
+def histogram(name: str, documentation: str, labels: tuple[str, ...] = (),
+              buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+
+# 各处理阶段的耗时。SMTP服务器记录parse、loop_check、spool和relay，适配器记录其内部的阶段
+STAGE_SECONDS = histogram('smtp_relayer_stage_duration_seconds',
+                          'Time spent in each stage of relaying a mail.', ('stage',))
+REPLIES = counter('smtp_relayer_smtp_replies_total', 'SMTP replies sent for DATA commands by code.', ('code',))
+RELAY_RESULTS = counter('smtp_relayer_relay_results_total', 'Results of relaying mails through the adapter by code.',
+                        ('adapter', 'code'))
+IN_FLIGHT = gauge('smtp_relayer_in_flight_relays', 'Mails currently being relayed through the adapter.')
+LOOP_ENTRIES = gauge('smtp_relayer_loop_detector_entries', 'Mails tracked by the local email loop detector.')
+
+
+def reply_code(reply: str) -> str:
+    """取出SMTP响应的状态码，用作指标标签"""
+    return reply[:3] if reply[:3].isdigit() else 'unknown'
+
+
+class MetricsServer:
+    """
+    以Prometheus文本格式输出指标的HTTP服务器。
+
+    与SMTP服务器运行在同一个事件循环中，只处理`GET /metrics`，每个连接响应一次后关闭。
+    """
+
+    def __init__(self, host: str, port: int, registry: Registry = REGISTRY, request_timeout: float = 5):
+        self.host = host
+        self.port = port
+        self.__registry = registry
+        self.__request_timeout = request_timeout
+        self.__server: asyncio.Server | None = None
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.__request_timeout)
+            method, path, *_ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+            if method not in ('GET', 'HEAD'):
+                status, body = '405 Method Not Allowed', b''
+            elif path.split('?', 1)[0] != '/metrics':
+                status, body = '404 Not Found', b''
+            else:
+                status, body = '200 OK', self.__registry.render().encode()
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode()
+            )
+            if method != 'HEAD':
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__handle, host=self.host, port=self.port)
+        logger.info(f'Metrics endpoint listening on http://{self.host}:{self.port}/metrics.')
+
+    async def stop(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
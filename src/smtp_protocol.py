@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from aiosmtpd.smtp import SMTP as SMTPProtocol, MISSING, syntax
+from util import SpillBuffer, release
+
+logger = logging.getLogger(__name__)
+
+
+class SpillingSMTP(SMTPProtocol):
+    """
+    接收大邮件时把内容写入临时文件的SMTP协议实现。
+
+    `aiosmtpd`会把`DATA`的全部内容拼接成`bytes`保存在内存中。此实现在内容超过`spill_threshold`字节后
+    将其写入`spill_dir`中的临时文件，`envelope.content`为临时文件的只读`mmap`，
+    处理函数返回后立即释放。未超过阈值的邮件仍然是`bytes`。
+    `data_size_limit`的含义与`aiosmtpd`相同，超过时响应`552`，为0时不限制。
+    只支持`decode_data=False`。
+    """
+
+    def __init__(self, handler, *, spill_threshold: int = 0, spill_dir: str | None = None, **kwargs):
+        super().__init__(handler, decode_data=False, **kwargs)
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+
+    @syntax('DATA')
+    async def smtp_DATA(self, arg: str) -> None:
+        # 流程与`aiosmtpd.smtp.SMTP.smtp_DATA`一致，只是把内容写入`SpillBuffer`
+        if await self.check_helo_needed():
+            return
+        if await self.check_auth_needed('DATA'):
+            return
+        if not self.envelope.rcpt_tos:
+            await self.push('503 Error: need RCPT command')
+            return
+        if arg:
+            await self.push('501 Syntax: DATA')
+            return
+
+        await self.push('354 End data with <CR><LF>.<CR><LF>')
+        buffer = SpillBuffer(self.spill_threshold, self.spill_dir)
+        limit = self.data_size_limit
+        received = 0
+        line_fragments: list[bytes] = []
+        # 与`aiosmtpd`相同，超过限制后继续读完剩余内容再响应
+        error: str | None = None
+        try:
+            while self.transport is not None:
+                try:
+                    line = await self._reader.readuntil(b'\r\n')
+                except asyncio.CancelledError:
+                    logger.info('Connection lost during DATA.')
+                    self._writer.close()
+                    raise
+                except asyncio.LimitOverrunError as e:
+                    if error is None:
+                        error = '500 Line too long (see RFC5321 4.5.3.1.6)'
+                    buffer.discard()
+                    line = await self._reader.read(e.consumed)
+                # 单独一行`.`表示内容结束
+                if not line_fragments and line == b'.\r\n':
+                    break
+                received += len(line)
+                if error is None and limit and received > limit:
+                    error = '552 Error: Too much mail data'
+                    buffer.discard()
+                line_fragments.append(line)
+                if not line.endswith(b'\r\n'):
+                    continue
+                if error is None:
+                    line = b''.join(line_fragments)
+                    if len(line) > self.line_length_limit:
+                        error = '500 Line too long (see RFC5321 4.5.3.1.6)'
+                        buffer.discard()
+                    else:
+                        # 去掉行首用于透明传输的`.`(RFC 5321 4.5.2)
+                        await buffer.write(line[1:] if line.startswith(b'.') else line)
+                line_fragments.clear()
+
+            if error is not None:
+                await self.push(error)
+                self._set_post_data_state()
+                return
+
+            content = await buffer.getvalue()
+        finally:
+            buffer.discard()
+        if not isinstance(content, bytes):
+            logger.debug('Mail data (%d bytes) spilled to a temporary file.', len(content))
+        self.envelope.content = self.envelope.original_content = content
+        try:
+            status = await self._call_handler_hook('DATA')
+        finally:
+            release(content)
+        self._set_post_data_state()
+        await self.push('250 OK' if status is MISSING else status)
@@ -1,71 +1,45 @@
+import os
+import re
 import time
-import hashlib
+import signal
+import socket
 import inspect
 import asyncio
 import logging
+import functools
 import importlib
 from datetime import datetime, timedelta
-from email import message_from_bytes
-from email.header import make_header, decode_header
-from email.utils import getaddresses
 from email.message import EmailMessage
-from email.utils import parseaddr, formataddr
+from email.utils import formataddr
 from aiosmtpd.smtp import Envelope
-from aiosmtpd.controller import Controller
-from config import SMTP, ADAPTER
-from util import get_local_ip
+from config import SMTP, ADAPTER, SPOOL, METRICS
+from metrics import MetricsServer, STAGE_SECONDS, REPLIES, RELAY_RESULTS, IN_FLIGHT, LOOP_ENTRIES, reply_code
+from spool import Spool
+from smtp_protocol import SpillingSMTP
+from util import get_local_ip, MailContext
+from util import RespClient
+from loop_detector import (
+    EmailLoopDetector, LoopStateBackend, MemoryLoopStateBackend, RedisLoopStateBackend, get_digest_factory
+)
 
 logger = logging.getLogger(__name__)
 logging.getLogger('mail.log').setLevel(logging.WARNING)
 adapter_module = importlib.import_module(f'adapter.{ADAPTER.use}')
 adapter = getattr(adapter_module, 'Adapter')()
+spool: Spool | None = None
+metrics_server: MetricsServer | None = None
+loop_state: LoopStateBackend | None = None
+email_loop_digest_factory = get_digest_factory(SMTP.email_loop_hash)
 
 
-class Handler:
-    __email_loop_check_hash = {}
+async def send_by_adapter(envelope: Envelope) -> str:
+    """通过适配器发送邮件。同步的`send_mail`在线程中执行，以免阻塞事件循环"""
+    if inspect.iscoroutinefunction(adapter.send_mail):
+        return await adapter.send_mail(envelope)
+    return await asyncio.to_thread(adapter.send_mail, envelope)
 
-    @classmethod
-    async def task_clean_email_loop_check_hash(cls):
-        """定时清理无用的邮件哈希记录的后台任务"""
-
-        def __show_email_loop_check_hash():
-            if len(cls.__email_loop_check_hash) == 0:
-                logger.debug(f'\tEmpty record.')
-            for _mail_hash, _mail_data in cls.__email_loop_check_hash.items():
-                debug_msg = 'OK.' if _mail_data["ban_until"] is None \
-                    else f'Banned until {_mail_data["ban_until"].strftime("%Y-%m-%d %H:%M:%S")}.'
-                logger.debug(f'\t{_mail_hash}: {debug_msg}')
-                for _mail_time in _mail_data['time_history']:
-                    logger.debug(f'\t\t{_mail_time.strftime("%Y-%m-%d %H:%M:%S")}')
-
-        while True:
-            await asyncio.sleep(600)
-
-            logger.debug(f'Before cleaning email loop check hash:')
-            __show_email_loop_check_hash()
-
-            now = datetime.now()
-            to_delete_hash = []
-            for mail_hash, mail_data in cls.__email_loop_check_hash.items():
-                if mail_data['ban_until'] is not None:
-                    if now > mail_data['ban_until']:
-                        to_delete_hash.append(mail_hash)
-                        continue
-
-                mail_time_history = []
-                for mail_time in mail_data['time_history']:
-                    if now - mail_time < timedelta(minutes=SMTP.email_loop_check_time_minutes):
-                        mail_time_history.append(mail_time)
-                if len(mail_time_history) == 0:
-                    to_delete_hash.append(mail_hash)
-                else:
-                    cls.__email_loop_check_hash[mail_hash]['time_history'] = mail_time_history
-            for mail_hash in to_delete_hash:
-                del cls.__email_loop_check_hash[mail_hash]
-
-            logger.debug(f'After cleaning email loop check hash:')
-            __show_email_loop_check_hash()
 
+class Handler:
     @staticmethod
     def __gen_email_loop_alert_envelope(from_addr, to_addr, text, attachment):
         """生成告警邮件的Envelope对象"""
@@ -87,22 +61,13 @@ class Handler:
     @staticmethod
     def get_sender_receiver(envelope: Envelope):
         """解析邮件的发件人和收件人"""
-        message = message_from_bytes(envelope.content)
-        from_header = message.get("From")
-        from_name, from_addr = parseaddr(from_header)
-        from_name = str(make_header(decode_header(from_name)))
-        sender = (from_name, from_addr)
-        recipients = []
-        for header in ("To", "Cc", "Bcc"):
-            if header in message:
-                recipients.extend(getaddresses([message[header]]))
-        receivers = [(name, addr) for name, addr in recipients]
-        return sender, receivers
+        context = MailContext.of(envelope)
+        return context.sender, context.receivers
 
     @classmethod
     async def __email_loop_check(cls, envelope: Envelope):
         """检查是否出现邮件死循环"""
-        logger.info(f'Checking email loop...')
+        logger.info('Checking email loop...')
 
         # 解析收件人和发件人
         sender, receivers = cls.get_sender_receiver(envelope)
@@ -110,44 +75,25 @@ class Handler:
         to_addrs = [receiver[1] for receiver in receivers]
         to_addrs_str = ','.join(to_addrs)
 
-        # 拼接收发地址和邮件内容，计算哈希
+        # 依次输入收发地址和邮件正文，增量计算哈希，不复制邮件内容
         content = envelope.content
-        sep = b"\r\n\r\n"
-        pos = content.find(sep)
-        if pos == -1:
-            sep = b"\n\n"
-            pos = content.find(sep)
-        if pos == -1:
-            body = content
-        else:
-            body = content[pos + len(sep):]
-        body = f'From:{from_addr} To:{to_addrs_str} '.encode() + body
-        body_hash = hashlib.sha256(body).hexdigest()
-        logger.debug(f'Email hash: {body_hash}')
-        now = datetime.now()
-
-        # 根据哈希判断是否为已经被ban的循环邮件
-        cls.__email_loop_check_hash.setdefault(body_hash, {'ban_until': None, 'time_history': []})
-        if cls.__email_loop_check_hash[body_hash]['ban_until'] is not None:
-            if now <= cls.__email_loop_check_hash[body_hash]['ban_until']:
-                error = (f'Found email loop. Same email will be rejected until '
-                         f'{cls.__email_loop_check_hash[body_hash]["ban_until"].strftime("%Y-%m-%d %H:%M:%S")}.')
-                logger.warning(error)
-                raise Exception(f'550 {error}')
-            else:
-                del cls.__email_loop_check_hash[body_hash]
-
-        # 不是已经被ban的循环邮件，统计此邮件在规定时间内被发送的次数
-        body_hash_history = []
-        for body_hash_time in cls.__email_loop_check_hash[body_hash]['time_history']:
-            if now - body_hash_time < timedelta(minutes=SMTP.email_loop_check_time_minutes):
-                body_hash_history.append(body_hash_time)
-        body_hash_history.append(now)
-        cls.__email_loop_check_hash[body_hash]['time_history'] = body_hash_history
+        context = MailContext.of(envelope)
+        digest = email_loop_digest_factory()
+        digest.update(f'From:{from_addr} To:{to_addrs_str} '.encode())
+        digest.update(memoryview(content)[context.body_offset or 0:])
+        body_hash = context.digest = digest.digest()
+        logger.debug('Email hash: %s', body_hash.hex())
+
+        # 根据哈希判断是否为已经被ban的循环邮件，并统计此邮件在规定时间内被发送的次数
+        result = await loop_state.check(body_hash)
+        if result.banned:
+            ban_until = datetime.now() + timedelta(seconds=result.ban_remaining_seconds)
+            error = (f'Found email loop. Same email will be rejected until '
+                     f'{ban_until.strftime("%Y-%m-%d %H:%M:%S")}.')
+            logger.warning(error)
+            raise Exception(f'550 {error}')
         # 如果超过阈值，利用哈希ban掉此邮件
-        if len(cls.__email_loop_check_hash[body_hash]['time_history']) >= SMTP.email_loop_threshold:
-            cls.__email_loop_check_hash[body_hash]['ban_until'] = (
-                    now + timedelta(minutes=SMTP.email_loop_ban_time_minutes))
+        if result.triggered:
             to_addrs_str = ','.join(to_addrs)
             error = (f'Found email loop from `{from_addr}` to `{to_addrs_str}` '
                      f'in {SMTP.email_loop_check_time_minutes} minutes. '
@@ -164,12 +110,9 @@ class Handler:
                             from_addr=SMTP.email_loop_alert_from_email,
                             to_addr=SMTP.email_loop_alert_to_email,
                             text=error,
-                            attachment=content
+                            attachment=bytes(content)
                         )
-                        if inspect.iscoroutinefunction(adapter.send_mail):
-                            await adapter.send_mail(alert_envelope)
-                        else:
-                            adapter.send_mail(alert_envelope)
+                        await send_by_adapter(alert_envelope)
                     except Exception as e:
                         logger.error(f'Error sending alert email: {e}')
 
@@ -177,54 +120,186 @@ class Handler:
         else:
             logger.info('Email loop check OK.')
 
+    @staticmethod
+    def reply_from_exception(e: Exception) -> str:
+        """将异常信息转换为SMTP响应"""
+        try:
+            error_message = str(e)
+            error_code = int(error_message[:3])
+            error_message = error_message[4:]
+            return f'{error_code} {error_message}'
+        except (ValueError, IndexError):
+            logger.warning(f'Unexpected exception while decoding exception: {e}')
+            return f'550 Service error: {e}'
+
     @classmethod
-    async def handle_DATA(cls, _, __, envelope):
-        logger.info('Received a new mail.')
+    async def relay(cls, envelope: Envelope, raise_uncoded: bool = False) -> str:
+        """
+        通过适配器转发邮件，返回SMTP响应。
+
+        `raise_uncoded`为真时，不带SMTP状态码的异常不转换为`550`而是继续抛出，由本地邮件队列作为临时错误重试。
+        """
+        IN_FLIGHT.inc()
+        __timer_start = time.perf_counter()
         try:
-            if SMTP.stop_email_loop:
-                await cls.__email_loop_check(envelope)
-            logger.info(f'Sending mail by adapter {ADAPTER.use}...')
-            __timer_start = time.perf_counter()
-            if inspect.iscoroutinefunction(adapter.send_mail):
-                result = await adapter.send_mail(envelope)
-            else:
-                result = adapter.send_mail(envelope)
+            logger.info('Sending mail by adapter %s...', ADAPTER.use)
+            result = await send_by_adapter(envelope)
+            if not isinstance(result, str):
+                raise Exception(f'550 Invalid reply from adapter: {result!r}')
             __elapsed = time.perf_counter() - __timer_start
-            logger.info(f'Mail has been sent.')
-            logger.debug(f'Sending time: {__elapsed:.2f}s.')
+            logger.info('Mail has been sent.')
+            logger.debug('Sending time: %.2fs.', __elapsed)
 
-            return result
+        except Exception as e:
+            logger.error('Failed to send mail:\n\t%s', e)
+            if raise_uncoded and not str(e)[:3].isdigit():
+                RELAY_RESULTS.inc(adapter=ADAPTER.use, code='451')
+                raise
+            result = cls.reply_from_exception(e)
+        finally:
+            IN_FLIGHT.dec()
+            STAGE_SECONDS.observe(time.perf_counter() - __timer_start, stage='relay')
+        RELAY_RESULTS.inc(adapter=ADAPTER.use, code=reply_code(result))
+        return result
 
+    @classmethod
+    async def __accept(cls, envelope: Envelope) -> str:
+        try:
+            # 只解析一次邮件头部，结果缓存在envelope上供后续流程复用
+            with STAGE_SECONDS.time(stage='parse'):
+                MailContext.of(envelope)
+            if SMTP.stop_email_loop:
+                with STAGE_SECONDS.time(stage='loop_check'):
+                    await cls.__email_loop_check(envelope)
+            if spool is not None:
+                # 启用队列时，邮件落盘后立即响应，由后台投递协程发送
+                with STAGE_SECONDS.time(stage='spool'):
+                    msg_id = await spool.put(envelope)
+                logger.info('Mail queued as `%s`.', msg_id)
+                return f'250 Message queued as {msg_id}'
         except Exception as e:
-            logger.error(f'Failed to send mail:\n\t{e}')
-            try:
-                error_message = str(e)
-                error_code = int(error_message[:3])
-                error_message = error_message[4:]
-                return f'{error_code} {error_message}'
-            except (ValueError, IndexError):
-                logger.warning(f'Unexpected exception while decoding exception: {e}')
-                return f'550 Service error: {e}'
-
-
-async def start():
-    # if inspect.iscoroutinefunction(adapter.start):
-    #     await adapter.start()
-    # else:
-    #     adapter.start()
-    asyncio.create_task(Handler.task_clean_email_loop_check_hash())
+            logger.error('Failed to accept mail:\n\t%s', e)
+            return cls.reply_from_exception(e)
+
+        return await cls.relay(envelope)
+
+    @classmethod
+    async def handle_DATA(cls, _, __, envelope):
+        logger.info('Received a new mail.')
+        reply = await cls.__accept(envelope)
+        REPLIES.inc(code=reply_code(reply))
+        return reply
+
+
+def create_loop_state() -> LoopStateBackend:
+    """根据配置创建邮件循环检测的状态后端"""
+    if not SMTP.stop_email_loop:
+        return LoopStateBackend()
+    if SMTP.email_loop_check_time_minutes <= 0:
+        # 检测时间窗口为0时不会检测到循环，视为关闭检测
+        logger.warning('`email_loop_check_time_minutes` is 0. Email loop check is disabled.')
+        return LoopStateBackend()
+    detector = EmailLoopDetector(
+        threshold=SMTP.email_loop_threshold,
+        window_seconds=SMTP.email_loop_check_time_minutes * 60,
+        ban_seconds=SMTP.email_loop_ban_time_minutes * 60,
+        max_entries=SMTP.email_loop_max_entries
+    )
+    if SMTP.email_loop_backend == 'redis':
+        return RedisLoopStateBackend(
+            client=RespClient.from_url(SMTP.email_loop_redis_url, timeout=SMTP.email_loop_redis_timeout_seconds),
+            threshold=SMTP.email_loop_threshold,
+            window_seconds=SMTP.email_loop_check_time_minutes * 60,
+            ban_seconds=SMTP.email_loop_ban_time_minutes * 60,
+            fallback=detector,
+            key_prefix=SMTP.email_loop_redis_key_prefix
+        )
+    if SMTP.email_loop_backend != 'memory':
+        raise ValueError(f'Unknown email loop backend `{SMTP.email_loop_backend}`. Expected `memory` or `redis`.')
+    if SMTP.workers > 1:
+        logger.warning('Email loop state is kept per worker process. Loops spread across workers may be '
+                       'detected later than expected. Set `email_loop_backend: redis` to share the state.')
+    return MemoryLoopStateBackend(detector)
+
+
+def create_spool(worker_index: int) -> Spool:
+    """
+    根据配置创建本地邮件队列。
+
+    多个工作进程时每个进程使用独立的队列分片：0号进程使用`spool.path`，其他进程使用`<spool.path>/worker-<N>`。
+    减少工作进程数量后，不再使用的分片中的邮件由0号进程接管。
+    """
+    path = SPOOL.path if worker_index == 0 else os.path.join(SPOOL.path, f'worker-{worker_index}')
+    adopt_paths = []
+    if worker_index == 0 and os.path.isdir(SPOOL.path):
+        for name in os.listdir(SPOOL.path):
+            if (match := re.fullmatch(r'worker-(\d+)', name)) and int(match.group(1)) >= SMTP.workers:
+                adopt_paths.append(os.path.join(SPOOL.path, name))
+    return Spool(
+        path=path,
+        deliver=functools.partial(Handler.relay, raise_uncoded=True),
+        workers=SPOOL.workers,
+        max_attempts=SPOOL.max_attempts,
+        retry_base_seconds=SPOOL.retry_base_seconds,
+        retry_max_seconds=SPOOL.retry_max_seconds,
+        adopt_paths=adopt_paths,
+        mmap_threshold=SMTP.data_spill_threshold_bytes
+    )
+
+
+async def start(worker_index: int = 0):
+    """
+    启动适配器和SMTP服务器，直到收到`SIGTERM`或被中断。
+
+    `worker_index`为当前工作进程的编号。配置了多个工作进程时，各进程通过`SO_REUSEPORT`监听同一端口，
+    由内核在进程之间分配连接。
+    """
+    global spool, loop_state, metrics_server
+    stopping = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    except NotImplementedError:
+        # Windows不支持为事件循环注册信号处理函数
+        pass
+    if inspect.iscoroutinefunction(adapter.start):
+        await adapter.start()
+    else:
+        adapter.start()
+    loop_state = create_loop_state()
+    await loop_state.start()
+    LOOP_ENTRIES.set_function(lambda: len(loop_state))
+    if SPOOL.enabled:
+        spool = create_spool(worker_index)
+        await spool.start()
     if SMTP.listen_host == 'auto':
         SMTP.listen_host = get_local_ip()
-    controller = Controller(Handler(), hostname=SMTP.listen_host, port=SMTP.listen_port)
-    controller.start()
+    # SMTP服务器与适配器、后台任务运行在同一个事件循环中
+    handler = Handler()
+    # 只解析一次本机域名。未指定时`aiosmtpd`会在每个新连接中阻塞地调用`socket.getfqdn()`，拖慢同一事件循环中的转发
+    hostname = await asyncio.to_thread(socket.getfqdn)
+    server = await asyncio.get_running_loop().create_server(
+        lambda: SpillingSMTP(handler, hostname=hostname, data_size_limit=SMTP.data_size_limit,
+                             spill_threshold=SMTP.data_spill_threshold_bytes, spill_dir=SMTP.data_spill_dir),
+        host=SMTP.listen_host, port=SMTP.listen_port,
+        reuse_port=SMTP.workers > 1
+    )
     logger.info(f'SMTP server listening on {SMTP.listen_host}:{SMTP.listen_port}.')
+    if METRICS.enabled:
+        # 多个工作进程时，每个进程在各自的端口上输出本进程的指标
+        metrics_server = MetricsServer(METRICS.listen_host, METRICS.listen_port + worker_index)
+        await metrics_server.start()
     try:
-        while True:
-            await asyncio.sleep(3600)
-    except KeyboardInterrupt:
+        await stopping.wait()
+    except (KeyboardInterrupt, asyncio.CancelledError):
         pass
     finally:
-        controller.stop()
+        server.close()
+        await server.wait_closed()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        if spool is not None:
+            await spool.stop()
+        await loop_state.stop()
         if inspect.iscoroutinefunction(adapter.stop):
             await adapter.stop()
         else:
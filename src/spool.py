@@ -0,0 +1,232 @@
+import os
+import re
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Awaitable, Callable
+from aiosmtpd.smtp import Envelope
+from util import MailContext, map_file, release
+
+logger = logging.getLogger(__name__)
+
+# 适配器在临时错误中给出的重试等待时间，例如`451 ..., retry after 30s: ...`
+RETRY_AFTER_PATTERN = re.compile(r'retry after (\d+(?:\.\d+)?)\s*s', re.IGNORECASE)
+
+
+class Spool:
+    """
+    本地持久化邮件队列。
+
+    邮件在接收时写入`<path>/queue`目录并落盘(fsync)，随后立即响应客户端；
+    后台的投递协程从队列中取出邮件交给适配器发送，失败时按指数退避重试，响应中带有`retry after <N>s`时至少等待N秒。
+    投递时抛出的异常视为临时错误，不是`状态码 描述信息`格式的响应视为永久失败。
+    每封邮件对应两个文件：`<id>.eml`保存原始内容，`<id>.json`保存信封和投递状态。
+    `.json`文件总是最后写入，因此程序重启时只有存在`.json`的邮件才会被恢复投递。
+    永久失败或超过最大尝试次数的邮件会被移动到`<path>/failed`目录。
+    `adopt_paths`中的其他队列目录里未投递的邮件会在启动时被移入本队列，用于接管已不再使用的分片。
+    超过`mmap_threshold`字节的邮件在投递时以只读`mmap`读取，为0时总是读入内存。
+    """
+
+    def __init__(self, path: str, deliver: Callable[[Envelope], Awaitable[str]], workers: int = 4,
+                 max_attempts: int = 10, retry_base_seconds: float = 30, retry_max_seconds: float = 3600,
+                 adopt_paths: list[str] | None = None, mmap_threshold: int = 0):
+        self.path = path
+        self.queue_path = os.path.join(path, 'queue')
+        self.failed_path = os.path.join(path, 'failed')
+        self.__deliver = deliver
+        self.__workers_count = max(workers, 1)
+        self.__max_attempts = max_attempts
+        self.__retry_base_seconds = retry_base_seconds
+        self.__retry_max_seconds = retry_max_seconds
+        self.__adopt_paths = adopt_paths or []
+        self.__mmap_threshold = mmap_threshold
+        self.__queue: asyncio.Queue | None = None
+        self.__workers: list[asyncio.Task] = []
+        self.__retry_handles: dict[str, asyncio.TimerHandle] = {}
+
+    @staticmethod
+    def __write_file(path: str, data: bytes):
+        """写入临时文件并fsync，再原子地重命名为目标文件"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def __fsync_dir(self):
+        # 保证重命名操作本身也已落盘，Windows不支持对目录fsync
+        if os.name != 'posix':
+            return
+        fd = os.open(self.queue_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __write_meta(self, msg_id: str, meta: dict):
+        self.__write_file(os.path.join(self.queue_path, f'{msg_id}.json'), json.dumps(meta).encode())
+
+    def __write_message(self, msg_id: str, envelope: Envelope):
+        self.__write_file(os.path.join(self.queue_path, f'{msg_id}.eml'), envelope.content)
+        self.__write_meta(msg_id, {
+            'mail_from': envelope.mail_from,
+            'rcpt_tos': list(envelope.rcpt_tos),
+            'attempts': 0,
+            'next_attempt_at': 0,
+            'received_at': time.time()
+        })
+        self.__fsync_dir()
+
+    def __read_message(self, msg_id: str) -> tuple[dict, Envelope]:
+        with open(os.path.join(self.queue_path, f'{msg_id}.json'), 'rb') as f:
+            meta = json.load(f)
+        envelope = Envelope()
+        envelope.mail_from = meta['mail_from']
+        envelope.rcpt_tos = meta['rcpt_tos']
+        envelope.content = envelope.original_content = map_file(
+            os.path.join(self.queue_path, f'{msg_id}.eml'), self.__mmap_threshold
+        )
+        return meta, envelope
+
+    def __remove_message(self, msg_id: str):
+        for suffix in ('.json', '.eml'):
+            try:
+                os.remove(os.path.join(self.queue_path, f'{msg_id}{suffix}'))
+            except FileNotFoundError:
+                pass
+
+    def __move_to_failed(self, msg_id: str, meta: dict, reply: str):
+        meta['last_reply'] = reply
+        self.__write_file(os.path.join(self.failed_path, f'{msg_id}.json'), json.dumps(meta).encode())
+        os.replace(os.path.join(self.queue_path, f'{msg_id}.eml'), os.path.join(self.failed_path, f'{msg_id}.eml'))
+        os.remove(os.path.join(self.queue_path, f'{msg_id}.json'))
+
+    def __adopt(self):
+        """把其他队列目录中的完整邮件移入本队列，先移动`.eml`再移动`.json`"""
+        adopted = 0
+        for path in self.__adopt_paths:
+            queue_path = os.path.join(path, 'queue')
+            if not os.path.isdir(queue_path):
+                continue
+            names = set(os.listdir(queue_path))
+            for name in names:
+                msg_id, suffix = os.path.splitext(name)
+                if suffix != '.json' or f'{msg_id}.eml' not in names:
+                    continue
+                for suffix in ('.eml', '.json'):
+                    os.replace(os.path.join(queue_path, f'{msg_id}{suffix}'),
+                               os.path.join(self.queue_path, f'{msg_id}{suffix}'))
+                adopted += 1
+        if adopted:
+            self.__fsync_dir()
+            logger.info(f'Adopted {adopted} mail(s) from unused spool shard(s).')
+
+    def __recover(self) -> list[tuple[str, float]]:
+        """扫描队列目录，清理未写完的文件，返回待投递的邮件ID和下次投递时间"""
+        self.__adopt()
+        pending = []
+        names = set(os.listdir(self.queue_path))
+        for name in names:
+            msg_id, suffix = os.path.splitext(name)
+            if suffix == '.tmp' or (suffix == '.eml' and f'{msg_id}.json' not in names):
+                logger.warning(f'Removing incomplete spool file `{name}`.')
+                os.remove(os.path.join(self.queue_path, name))
+            elif suffix == '.json':
+                try:
+                    with open(os.path.join(self.queue_path, name), 'rb') as f:
+                        meta = json.load(f)
+                    pending.append((msg_id, meta.get('next_attempt_at', 0)))
+                except (OSError, ValueError) as e:
+                    logger.error(f'Failed to load spool file `{name}`: {e}')
+        return pending
+
+    def __schedule(self, msg_id: str, delay: float):
+        if delay <= 0:
+            self.__queue.put_nowait(msg_id)
+            return
+
+        def __enqueue():
+            self.__retry_handles.pop(msg_id, None)
+            self.__queue.put_nowait(msg_id)
+
+        self.__retry_handles[msg_id] = asyncio.get_running_loop().call_later(delay, __enqueue)
+
+    async def start(self):
+        os.makedirs(self.queue_path, exist_ok=True)
+        os.makedirs(self.failed_path, exist_ok=True)
+        self.__queue = asyncio.Queue()
+        pending = await asyncio.to_thread(self.__recover)
+        now = time.time()
+        for msg_id, next_attempt_at in sorted(pending, key=lambda x: x[1]):
+            self.__schedule(msg_id, next_attempt_at - now)
+        if pending:
+            logger.info(f'Recovered {len(pending)} mail(s) from spool.')
+        self.__workers = [asyncio.create_task(self.__task_deliver(i)) for i in range(self.__workers_count)]
+        logger.info(f'Spool started with {self.__workers_count} delivery worker(s) at `{self.path}`.')
+
+    async def put(self, envelope: Envelope) -> str:
+        """将邮件持久化到队列中，返回队列ID"""
+        # 已经计算过邮件摘要时，用摘要作为ID的一部分，便于与邮件循环检查的日志对应
+        digest = MailContext.of(envelope).digest
+        msg_id = f'{time.time_ns():x}-{digest[:8].hex()}' if digest else uuid.uuid4().hex
+        await asyncio.to_thread(self.__write_message, msg_id, envelope)
+        self.__queue.put_nowait(msg_id)
+        return msg_id
+
+    async def __task_deliver(self, index: int):
+        """投递协程，从队列中取出邮件并通过适配器发送"""
+        while True:
+            msg_id = await self.__queue.get()
+            try:
+                await self.__deliver_one(msg_id)
+            except Exception as e:
+                # 读写队列文件出错时不丢弃邮件，稍后重试
+                logger.error('[spool-%d] Unexpected error while delivering `%s`: %s', index, msg_id, e)
+                self.__schedule(msg_id, self.__retry_base_seconds)
+            finally:
+                self.__queue.task_done()
+
+    async def __deliver_one(self, msg_id: str):
+        meta, envelope = await asyncio.to_thread(self.__read_message, msg_id)
+        meta['attempts'] += 1
+        logger.info('Delivering spooled mail `%s` (attempt %d)...', msg_id, meta['attempts'])
+        try:
+            reply = await self.__deliver(envelope)
+        except Exception as e:
+            # 计入尝试次数，避免无限重试
+            reply = f'451 Delivery error: {e!r}'
+        finally:
+            # 移动或删除文件之前先释放映射
+            release(envelope.content)
+        if not isinstance(reply, str) or not reply[:3].isdigit() or reply[0] not in '2345':
+            logger.warning('Spooled mail `%s` got an invalid reply: %r', msg_id, reply)
+            reply = f'550 Invalid reply: {reply!r}'
+        if reply.startswith('2'):
+            logger.info('Spooled mail `%s` delivered: %s', msg_id, reply)
+            await asyncio.to_thread(self.__remove_message, msg_id)
+        elif reply.startswith('5') or meta['attempts'] >= self.__max_attempts:
+            logger.error('Spooled mail `%s` failed permanently after %d attempt(s): %s', msg_id, meta['attempts'], reply)
+            await asyncio.to_thread(self.__move_to_failed, msg_id, meta, reply)
+        else:
+            delay = self.__retry_base_seconds * 2 ** (meta['attempts'] - 1)
+            if match := RETRY_AFTER_PATTERN.search(reply):
+                delay = max(delay, float(match.group(1)))
+            delay = min(delay, self.__retry_max_seconds)
+            meta['next_attempt_at'] = time.time() + delay
+            meta['last_reply'] = reply
+            await asyncio.to_thread(self.__write_meta, msg_id, meta)
+            logger.warning('Spooled mail `%s` deferred: %s. Retrying in %.0fs.', msg_id, reply, delay)
+            self.__schedule(msg_id, delay)
+
+    async def stop(self):
+        for handle in self.__retry_handles.values():
+            handle.cancel()
+        self.__retry_handles.clear()
+        for worker in self.__workers:
+            worker.cancel()
+        await asyncio.gather(*self.__workers, return_exceptions=True)
+        self.__workers = []
+        logger.info('Spool stopped.')
@@ -1,3 +1,10 @@
 from .ip import get_local_ip
+from .mail import MailContext, parse_message
+from .resp import RespClient, RespError
+from .log import BoundedQueueHandler
+from .spill import SpillBuffer, spill_bytes, map_file, release
 
-__all__ = [get_local_ip]
+__all__ = [
+    get_local_ip, MailContext, parse_message, RespClient, RespError, BoundedQueueHandler,
+    SpillBuffer, spill_bytes, map_file, release
+]
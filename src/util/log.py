@@ -0,0 +1,40 @@
+import queue
+import logging
+from logging.handlers import QueueHandler
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    把日志记录放入有界队列的处理器，由`logging.handlers.QueueListener`在后台线程中写入实际的处理器。
+
+    队列已满时按`policy`处理：`drop`丢弃此条记录，调用方不会等待；`block`等待队列有空位。
+    丢弃的数量会在之后的第一条成功入队的记录之前以一条警告报告。
+    """
+
+    def __init__(self, log_queue, policy: str = 'drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError(f'Unknown log queue policy `{policy}`. Expected `drop` or `block`.')
+        super().__init__(log_queue)
+        self.policy = policy
+        self.dropped = 0  # 累计丢弃的记录数量
+        self.__unreported = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.policy == 'block':
+            self.queue.put(record)
+            return
+        try:
+            if self.__unreported:
+                self.queue.put_nowait(self.__dropped_record())
+                self.__unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.__unreported += 1
+
+    def __dropped_record(self) -> logging.LogRecord:
+        return logging.LogRecord(
+            name=__name__, level=logging.WARNING, pathname=__file__, lineno=0,
+            msg=f'Log queue is full, {self.__unreported} record(s) dropped.', args=None, exc_info=None,
+            func=None
+        )
@@ -0,0 +1,62 @@
+from email.message import Message
+from email.parser import BytesHeaderParser
+from email.feedparser import BytesFeedParser
+from email.header import make_header, decode_header
+from email.utils import getaddresses, parseaddr
+from aiosmtpd.smtp import Envelope
+
+PARSE_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_message(content) -> Message:
+    """
+    完整解析邮件。
+
+    `content`可以是`bytes`、`mmap`等任何支持缓冲区协议的对象，分块输入解析器，不会先复制出整封邮件的`bytes`。
+    """
+    parser = BytesFeedParser()
+    with memoryview(content) as view:
+        for offset in range(0, len(view), PARSE_CHUNK_SIZE):
+            parser.feed(view[offset:offset + PARSE_CHUNK_SIZE].tobytes())
+    return parser.close()
+
+
+class MailContext:
+    """
+    邮件的解析结果。
+
+    每封邮件只解析一次头部，结果缓存在`Envelope`上，供邮件循环检查和适配器复用。
+    完整的MIME结构不缓存，需要时使用`parse_message()`解析。
+    """
+
+    def __init__(self, content: bytes):
+        # `content`也可能是写入临时文件的大邮件的只读`mmap`，只在处理此邮件期间有效
+        self.content = content
+        # 头部与正文之间以空行分隔，没有空行时整封邮件都视为头部
+        sep = b'\r\n\r\n'
+        pos = content.find(sep)
+        if pos == -1:
+            sep = b'\n\n'
+            pos = content.find(sep)
+        self.header_end: int = len(content) if pos == -1 else pos + len(sep)
+        self.body_offset: int | None = None if pos == -1 else pos + len(sep)
+        self.headers: Message = BytesHeaderParser().parsebytes(content[:self.header_end])
+
+        from_name, from_addr = parseaddr(self.headers.get('From'))
+        from_name = str(make_header(decode_header(from_name)))
+        self.sender: tuple[str, str] = (from_name, from_addr)
+        recipients = []
+        for header in ('To', 'Cc', 'Bcc'):
+            if header in self.headers:
+                recipients.extend(getaddresses([self.headers[header]]))
+        self.receivers: list[tuple[str, str]] = [(name, addr) for name, addr in recipients]
+        self.digest: bytes | None = None  # 邮件循环检查时计算的摘要，可作为邮件的标识
+
+    @classmethod
+    def of(cls, envelope: Envelope) -> 'MailContext':
+        """获取邮件的解析结果，已经解析过的邮件直接返回缓存"""
+        context = getattr(envelope, 'mail_context', None)
+        if context is None or context.content is not envelope.content:
+            context = cls(envelope.content)
+            envelope.mail_context = context
+        return context
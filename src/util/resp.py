@@ -0,0 +1,159 @@
+import asyncio
+from collections import deque
+from urllib.parse import urlparse
+
+
+class RespError(Exception):
+    """Redis协议中服务端返回的错误"""
+
+
+class RespClient:
+    """
+    精简的Redis协议(RESP2)客户端。
+
+    所有调用共用一条连接，请求写出后不等待响应即可继续写出下一个请求，
+    响应按顺序分派给各个调用者，因此并发调用天然是流水线化的。
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 6379, db: int = 0, password: str | None = None,
+                 username: str | None = None, timeout: float = 1.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.__reader: asyncio.StreamReader | None = None
+        self.__writer: asyncio.StreamWriter | None = None
+        self.__read_task: asyncio.Task | None = None
+        self.__waiters: deque[tuple[asyncio.Future, int]] = deque()
+        self.__connecting: asyncio.Lock = asyncio.Lock()
+
+    @classmethod
+    def from_url(cls, url: str, timeout: float = 1.0) -> 'RespClient':
+        """从`redis://[[username]:password@]host[:port][/db]`格式的URL创建客户端"""
+        parsed = urlparse(url)
+        if parsed.scheme != 'redis':
+            raise ValueError(f'Unsupported URL scheme `{parsed.scheme}`. Only `redis://` is supported.')
+        return cls(
+            host=parsed.hostname or '127.0.0.1',
+            port=parsed.port or 6379,
+            db=int(parsed.path.lstrip('/') or 0),
+            username=parsed.username or None,
+            password=parsed.password or None,
+            timeout=timeout
+        )
+
+    @property
+    def connected(self) -> bool:
+        return self.__writer is not None and not self.__writer.is_closing()
+
+    @staticmethod
+    def __encode(args: tuple) -> bytes:
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode()
+            elif isinstance(arg, (int, float)):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    async def __read_reply(self):
+        line = await self.__reader.readuntil(b'\r\n')
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            return RespError(payload.decode())
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = await self.__reader.readexactly(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [await self.__read_reply() for _ in range(length)]
+        raise RespError(f'Unexpected reply from server: {line!r}')
+
+    async def __task_read(self):
+        """按顺序读取响应并分派给等待的调用者"""
+        replies = []
+        try:
+            while True:
+                replies.append(await self.__read_reply())
+                if not self.__waiters:
+                    raise RespError(f'Unexpected reply without request: {replies[-1]!r}')
+                future, count = self.__waiters[0]
+                if len(replies) == count:
+                    self.__waiters.popleft()
+                    if not future.done():
+                        future.set_result(replies)
+                    replies = []
+        except Exception as e:
+            self.__fail(e)
+
+    def __fail(self, error: Exception):
+        if self.__read_task is not None and self.__read_task is not asyncio.current_task():
+            self.__read_task.cancel()
+        self.__read_task = None
+        if self.__writer is not None:
+            self.__writer.close()
+        self.__writer = None
+        while self.__waiters:
+            future, _ = self.__waiters.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(f'Connection to {self.host}:{self.port} lost: {error!r}'))
+
+    async def connect(self):
+        async with self.__connecting:
+            if self.connected:
+                return
+            self.__reader, self.__writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout
+            )
+            self.__read_task = asyncio.create_task(self.__task_read())
+            commands = []
+            if self.password:
+                commands.append(('AUTH', self.username, self.password) if self.username
+                                else ('AUTH', self.password))
+            if self.db:
+                commands.append(('SELECT', self.db))
+            if commands:
+                for reply in await self.pipeline(*commands):
+                    if isinstance(reply, RespError):
+                        await self.close()
+                        raise reply
+
+    async def pipeline(self, *commands: tuple) -> list:
+        """一次性写出多条命令并返回它们的响应。单条命令的错误以`RespError`对象的形式放在结果中"""
+        if not self.connected:
+            raise ConnectionError(f'Not connected to {self.host}:{self.port}')
+        future = asyncio.get_running_loop().create_future()
+        self.__waiters.append((future, len(commands)))
+        self.__writer.write(b''.join(self.__encode(command) for command in commands))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            # 服务端无响应，断开连接，后续调用会重新连接
+            self.__fail(TimeoutError(f'No reply within {self.timeout}s'))
+            raise
+
+    async def execute(self, *args):
+        reply = (await self.pipeline(args))[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    async def close(self):
+        if self.__read_task is not None:
+            self.__read_task.cancel()
+            self.__read_task = None
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
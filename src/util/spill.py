@@ -0,0 +1,94 @@
+import os
+import mmap
+import asyncio
+import tempfile
+
+SPILL_CHUNK_SIZE = 1024 * 1024
+
+
+class SpillBuffer:
+    """
+    接收邮件内容的缓冲区。
+
+    内容不超过`threshold`字节时保存在内存中；超过后写入临时文件，之后的内容每积累`SPILL_CHUNK_SIZE`字节
+    在线程中写入一次，内存中最多只保留一个分块。`threshold`为0时不写入文件。
+    临时文件创建后立即被删除(Windows上在关闭时删除)，只能通过`getvalue()`返回的只读`mmap`访问，
+    由操作系统按需换入换出，不计入进程的匿名内存。
+    """
+
+    def __init__(self, threshold: int = 0, spill_dir: str | None = None):
+        self.threshold = threshold
+        self.spill_dir = spill_dir or None
+        self.size = 0
+        self.__chunk = bytearray()
+        self.__file = None
+
+    @property
+    def spilled(self) -> bool:
+        return self.__file is not None
+
+    async def write(self, data: bytes):
+        self.__chunk += data
+        self.size += len(data)
+        if self.__file is None:
+            if not self.threshold or self.size <= self.threshold:
+                return
+            self.__file = tempfile.TemporaryFile(dir=self.spill_dir)
+        if len(self.__chunk) >= SPILL_CHUNK_SIZE:
+            await self.__flush()
+
+    async def __flush(self):
+        chunk = bytes(self.__chunk)
+        self.__chunk.clear()
+        await asyncio.to_thread(self.__file.write, chunk)
+
+    def discard(self):
+        """丢弃已接收的内容"""
+        self.__chunk.clear()
+        self.size = 0
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    async def getvalue(self) -> bytes | mmap.mmap:
+        """返回接收的全部内容：未写入文件时为`bytes`，否则为临时文件的只读`mmap`"""
+        if self.__file is None:
+            content = bytes(self.__chunk)
+            self.__chunk.clear()
+            return content
+        await self.__flush()
+        await asyncio.to_thread(self.__file.flush)
+        try:
+            return mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # 映射建立后不再需要文件描述符
+            self.__file.close()
+            self.__file = None
+
+
+def spill_bytes(data: bytes, threshold: int = 0, spill_dir: str | None = None) -> bytes | mmap.mmap:
+    """把超过`threshold`字节(`threshold`不为0时)的内容写入临时文件，以只读`mmap`返回。在线程中调用"""
+    if not threshold or len(data) <= threshold:
+        return data
+    with tempfile.TemporaryFile(dir=spill_dir or None) as f:
+        f.write(data)
+        f.flush()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def map_file(path: str, threshold: int = 0) -> bytes | mmap.mmap:
+    """读取文件内容，超过`threshold`字节(`threshold`不为0时)的文件以只读`mmap`返回"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if threshold and size > threshold:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return f.read()
+
+
+def release(content):
+    """释放`getvalue()`、`spill_bytes()`或`map_file()`返回的`mmap`。仍有`memoryview`引用时交给垃圾回收处理"""
+    if isinstance(content, mmap.mmap):
+        try:
+            content.close()
+        except BufferError:
+            pass